@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017 John Koelndorfer
+#
+# This file is part of mccdl.
+#
+# mccdl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mccdl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mccdl.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A local stand-in for the parts of Minecraft CurseForge and the MultiMC metadata site
+that mccdl talks to, for benchmarking mccdl without touching the real services.
+
+Modpack projects are synthetic: project PACK_PROJECT_BASE + N is a modpack of N mods.
+Mod projects are numbered from MOD_PROJECT_BASE; a fraction of the modpack manifest
+entries refer to files that no longer exist, which exercises mccdl's 404 fallback.
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import random
+import re
+import threading
+import time
+import zipfile
+
+
+class QuietThreadingHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping idle keep-alive connections is expected; don't spam tracebacks.
+        pass
+
+
+class FakeCurseForgeServer:
+    PACK_PROJECT_BASE = 900000
+    MOD_PROJECT_BASE = 100000
+    PACK_FILE_ID = 5000
+    MOD_FILE_ID = 2000
+    MINECRAFT_VERSION = "1.12.2"
+    FORGE_VERSION = "14.23.5.2847"
+    OVERRIDE_FILE_COUNT = 50
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, bandwidth=None, failure_rate=0.0,
+                 dead_file_rate=0.05, mod_size=256 * 1024, seed=0, throttle_rate=0.0, cdn_host=None):
+        """
+        latency is added to every request, in seconds. bandwidth, if given, caps the rate
+        at which each response body is sent, in bytes per second. failure_rate is the
+        probability that a download fails with a 503, and throttle_rate the probability
+        that it is refused with a 429 and a Retry-After of one second.
+
+        Like CurseForge, which redirects downloads to a CDN, file downloads redirect to
+        cdn_host if it is given: another name for this server, such as "localhost".
+        """
+        self.bandwidth = bandwidth
+        self.cdn_host = cdn_host
+        self.dead_file_rate = dead_file_rate
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.mod_size = mod_size
+        self.random = random.Random(seed)
+        self.stats = {"requests": 0, "bytes_sent": 0, "not_found": 0, "failures": 0, "throttled": 0}
+        self._lock = threading.Lock()
+        self._pack_cache = dict()
+        self._httpd = QuietThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+        self.throttle_rate = throttle_rate
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    @property
+    def cdn_base_url(self):
+        if self.cdn_host is None:
+            return ""
+        return "http://{}:{}".format(self.cdn_host, self._httpd.server_address[1])
+
+    @property
+    def forge_configuration_site(self):
+        return self.base_url + "/net.minecraftforge"
+
+    @classmethod
+    def pack_project_id(cls, mod_count):
+        return cls.PACK_PROJECT_BASE + mod_count
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            for k in self.stats:
+                self.stats[k] = 0
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def is_dead(self, project_id, file_id):
+        # Deterministic per project, so every run of a benchmark sees the same dead files.
+        return file_id == self.MOD_FILE_ID and random.Random(project_id).random() < self.dead_file_rate
+
+    def should_fail(self):
+        with self._lock:
+            return self.failure_rate > 0 and self.random.random() < self.failure_rate
+
+    def should_throttle(self):
+        with self._lock:
+            return self.throttle_rate > 0 and self.random.random() < self.throttle_rate
+
+    def mod_content(self, project_id, file_id):
+        pattern = "mod {} file {}\n".format(project_id, file_id).encode("utf-8")
+        return (pattern * (self.mod_size // len(pattern) + 1))[:self.mod_size]
+
+    def pack_content(self, mod_count):
+        with self._lock:
+            if mod_count in self._pack_cache:
+                return self._pack_cache[mod_count]
+        manifest = {
+            "minecraft": {
+                "version": self.MINECRAFT_VERSION,
+                "modLoaders": [{"id": "forge-" + self.FORGE_VERSION, "primary": True}],
+            },
+            "manifestType": "minecraftModpack",
+            "name": "Benchmark pack of {} mods".format(mod_count),
+            "overrides": "overrides",
+            "files": [
+                {"projectID": self.MOD_PROJECT_BASE + i, "fileID": self.MOD_FILE_ID, "required": True}
+                for i in range(mod_count)
+            ],
+        }
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr("manifest.json", json.dumps(manifest))
+            for i in range(self.OVERRIDE_FILE_COUNT):
+                zipf.writestr("overrides/config/mod{}.cfg".format(i), "# config {}\nenabled=true\n".format(i) * 20)
+        content = buf.getvalue()
+        with self._lock:
+            self._pack_cache[mod_count] = content
+        return content
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            routes = (
+                (r"^/projects/([0-9]+)/?$", "project_page"),
+                (r"^/projects/([0-9]+)/files/?$", "file_listing"),
+                (r"^/projects/([0-9]+)/files/latest$", "latest_file"),
+                (r"^/projects/([0-9]+)/files/([0-9]+)/download$", "file_download"),
+                (r"^/media/([0-9]+)/([0-9]+)/[^/]+$", "file_content"),
+                (r"^/avatars/([0-9]+)\.png$", "avatar"),
+                (r"^/net\.minecraftforge/([^/]+)\.json$", "forge_patch"),
+            )
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                server.count("requests")
+                if server.latency:
+                    time.sleep(server.latency)
+                for regex, handler_name in self.routes:
+                    match = re.match(regex, self.path)
+                    if match is not None:
+                        return getattr(self, handler_name)(*match.groups())
+                self.not_found()
+
+            def project_page(self, project_id):
+                avatar = "{}/avatars/{}.png".format(server.base_url, project_id)
+                body = '<html><body><div class="avatar-wrapper"><img src="{}"></div></body></html>'.format(avatar)
+                self.send_body(body.encode("utf-8"), "text/html")
+
+            def file_listing(self, project_id):
+                rows = "".join(
+                    '<tr class="project-file-list-item"><td><a class="overflow-tip" '
+                    'href="/projects/{0}/files/{1}">file {1}</a></td>'
+                    '<td><span class="version-label"> {2} </span></td></tr>'.format(
+                        project_id, file_id, server.MINECRAFT_VERSION
+                    )
+                    for file_id in (server.MOD_FILE_ID - 1, server.MOD_FILE_ID + 1, server.MOD_FILE_ID + 2)
+                )
+                body = "<html><body><div>{}</div><table>{}</table></body></html>".format("x" * 20000, rows)
+                self.send_body(body.encode("utf-8"), "text/html")
+
+            def latest_file(self, project_id):
+                self.file_download(project_id, str(server.PACK_FILE_ID))
+
+            def file_download(self, project_id, file_id):
+                project_id, file_id = int(project_id), int(file_id)
+                if server.is_dead(project_id, file_id):
+                    return self.not_found()
+                if project_id >= server.PACK_PROJECT_BASE:
+                    filename = "pack-{}.zip".format(project_id - server.PACK_PROJECT_BASE)
+                else:
+                    filename = "mod-{}-{}.jar".format(project_id, file_id)
+                self.send_response(302)
+                self.send_header("Location", "{}/media/{}/{}/{}".format(
+                    server.cdn_base_url, project_id, file_id, filename
+                ))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def file_content(self, project_id, file_id):
+                project_id, file_id = int(project_id), int(file_id)
+                if server.should_fail():
+                    server.count("failures")
+                    return self.send_body(b"try again later", "text/plain", status=503)
+                if server.should_throttle():
+                    server.count("throttled")
+                    return self.send_body(b"slow down", "text/plain", status=429, headers=(("Retry-After", "1"),))
+                if project_id >= server.PACK_PROJECT_BASE:
+                    content = server.pack_content(project_id - server.PACK_PROJECT_BASE)
+                else:
+                    content = server.mod_content(project_id, file_id)
+                etag = '"{}-{}-{}"'.format(project_id, file_id, len(content))
+                if self.headers.get("If-None-Match") == etag:
+                    return self.send_body(b"", None, status=304, headers=(("ETag", etag),))
+                self.send_range(content, etag)
+
+            def avatar(self, project_id):
+                self.send_body(b"\x89PNG\r\n\x1a\n" + b"\0" * 2048, "image/png")
+
+            def forge_patch(self, forge_version):
+                patch = {"formatVersion": 1, "uid": "net.minecraftforge", "version": forge_version}
+                self.send_body(json.dumps(patch).encode("utf-8"), "application/json")
+
+            def not_found(self):
+                server.count("not_found")
+                self.send_body(b"not found", "text/plain", status=404)
+
+            def send_range(self, content, etag):
+                match = re.match(r"^bytes=([0-9]+)-$", self.headers.get("Range", ""))
+                if match is not None and self.headers.get("If-Range") in (None, etag):
+                    start = int(match.group(1))
+                    if start >= len(content):
+                        return self.send_body(b"", None, status=416)
+                    headers = (
+                        ("ETag", etag),
+                        ("Content-Range", "bytes {}-{}/{}".format(start, len(content) - 1, len(content))),
+                    )
+                    return self.send_body(content[start:], "application/octet-stream", status=206, headers=headers)
+                self.send_body(content, "application/octet-stream", headers=(("ETag", etag),))
+
+            def send_body(self, body, content_type, status=200, headers=()):
+                self.send_response(status)
+                if content_type is not None:
+                    self.send_header("Content-Type", content_type)
+                for k, v in headers:
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command == "HEAD":
+                    return
+                self.write_throttled(body)
+
+            def write_throttled(self, body):
+                chunk_size = 64 * 1024
+                for offset in range(0, len(body), chunk_size):
+                    chunk = body[offset:offset + chunk_size]
+                    started = time.monotonic()
+                    self.wfile.write(chunk)
+                    server.count("bytes_sent", len(chunk))
+                    if server.bandwidth:
+                        remaining = len(chunk) / server.bandwidth - (time.monotonic() - started)
+                        if remaining > 0:
+                            time.sleep(remaining)
+
+        return Handler
+
+
+def main():
+    a = argparse.ArgumentParser(description="Run a local stand-in for CurseForge and the MultiMC metadata site.")
+    a.add_argument("--port", type=int, default=8765)
+    a.add_argument("--latency", type=float, default=0.0, help="Seconds of latency added to every request.")
+    a.add_argument("--bandwidth", type=float, default=None, help="Bytes per second per response.")
+    a.add_argument("--failure-rate", type=float, default=0.0, help="Probability that a download fails with 503.")
+    a.add_argument("--throttle-rate", type=float, default=0.0,
+                   help="Probability that a download is refused with 429.")
+    a.add_argument("--dead-file-rate", type=float, default=0.05, help="Fraction of mods whose file 404s.")
+    a.add_argument("--mod-size", type=int, default=256 * 1024, help="Size of each mod in bytes.")
+    a.add_argument("--cdn-host", type=str, default=None,
+                   help="Host name to redirect downloads to, such as localhost, as if it were a CDN.")
+    args = a.parse_args()
+
+    server = FakeCurseForgeServer(
+        port=args.port, latency=args.latency, bandwidth=args.bandwidth, failure_rate=args.failure_rate,
+        dead_file_rate=args.dead_file_rate, mod_size=args.mod_size, throttle_rate=args.throttle_rate,
+        cdn_host=args.cdn_host
+    )
+    print("Serving on {} (modpack of N mods: {}/projects/{}+N)".format(
+        server.base_url, server.base_url, server.PACK_PROJECT_BASE
+    ))
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
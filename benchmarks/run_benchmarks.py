@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017 John Koelndorfer
+#
+# This file is part of mccdl.
+#
+# mccdl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mccdl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mccdl.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks mccdl installs and upgrades against a local FakeCurseForgeServer.
+
+For every pack size, mccdl is run in a fresh process for each of these scenarios, in order:
+
+    cold-install    empty download cache, new instance
+    warm-install    cache filled by cold-install, another new instance
+    warm-upgrade    upgrade of the cold-install instance with a warm cache
+    cold-upgrade    upgrade of the same instance after emptying the cache and deleting its
+                    lockfile, with --reconcile none, so that every mod is downloaded again
+                    rather than kept or adopted from the instance
+
+Wall time, bytes served, throughput and the peak RSS of the mccdl process are reported.
+"""
+
+import argparse
+from collections import namedtuple
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_curseforge import FakeCurseForgeServer
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs mccdl with its upstream URLs pointed at the fake server.
+DRIVER = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import mccdl
+mccdl.CurseForgeClient.CURSE_BASE_URL = sys.argv[2]
+mccdl.MultiMcInstance.MULTIMC_FORGE_CONFIGURATION_SITE = sys.argv[3]
+sys.exit(mccdl.MccdlCommandLineApplication().run(sys.argv[4:]))
+"""
+
+SCENARIOS = ("cold-install", "warm-install", "warm-upgrade", "cold-upgrade")
+
+BenchmarkResult = namedtuple(
+    "BenchmarkResult", ("mods", "scenario", "exit_status", "wall_time", "bytes_served", "requests", "peak_rss")
+)
+
+
+class MccdlBenchmark:
+    def __init__(self, server, work_dir, jobs=None, mccdl_args=()):
+        self.jobs = jobs
+        self.mccdl_args = list(mccdl_args)
+        self.server = server
+        self.work_dir = work_dir
+
+    @property
+    def cache_dir(self):
+        return os.path.join(self.work_dir, "cache")
+
+    @property
+    def multimc_dir(self):
+        return os.path.join(self.work_dir, "multimc")
+
+    def run_size(self, mod_count):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        os.makedirs(os.path.join(self.multimc_dir, "icons"))
+        url = "{}/projects/{}".format(self.server.base_url, self.server.pack_project_id(mod_count))
+
+        results = list()
+        for scenario in SCENARIOS:
+            if scenario == "cold-upgrade":
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+                os.unlink(os.path.join(self.multimc_dir, "instances", "bench", "mccdl.lock.json"))
+            instance_name = "warm-install" if scenario == "warm-install" else "bench"
+            extra_args = ["--upgrade"] if scenario.endswith("upgrade") else []
+            if scenario == "cold-upgrade":
+                extra_args += ["--reconcile", "none"]
+            results.append(self.run_mccdl(mod_count, scenario, extra_args + [url, instance_name]))
+        return results
+
+    def run_mccdl(self, mod_count, scenario, args):
+        argv = ["-c", self.cache_dir, "--multimc-directory", self.multimc_dir, "-l", "error"]
+        if self.jobs is not None:
+            argv += ["--jobs", str(self.jobs)]
+        argv += self.mccdl_args + args
+
+        self.server.reset_stats()
+        started = time.monotonic()
+        process = subprocess.Popen([
+            sys.executable, "-c", DRIVER, REPO_DIR, self.server.base_url, self.server.forge_configuration_site
+        ] + argv)
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall_time = time.monotonic() - started
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        # ru_maxrss is in KiB on Linux and bytes on macOS.
+        peak_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        return BenchmarkResult(
+            mod_count, scenario, process.returncode, wall_time,
+            self.server.stats["bytes_sent"], self.server.stats["requests"], peak_rss
+        )
+
+
+def format_result(r):
+    throughput = r.bytes_served / r.wall_time / (1024 * 1024) if r.wall_time else 0
+    return "{:>6} {:<14} {:>6} {:>9.2f} {:>11.1f} {:>9} {:>10.1f} {:>10.1f}".format(
+        r.mods, r.scenario, r.exit_status, r.wall_time, r.bytes_served / (1024 * 1024),
+        r.requests, throughput, r.peak_rss / (1024 * 1024)
+    )
+
+
+def main():
+    a = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    a.add_argument("--sizes", type=str, default="10,100,1000",
+                   help="Comma separated pack sizes, in number of mods. Defaults to %(default)s.")
+    a.add_argument("--latency", type=float, default=0.02,
+                   help="Seconds of latency added to every request. Defaults to %(default)s.")
+    a.add_argument("--bandwidth", type=float, default=None,
+                   help="Per-response bandwidth cap in bytes per second. Unlimited by default.")
+    a.add_argument("--failure-rate", type=float, default=0.0,
+                   help="Probability that a download fails with a 503. Defaults to %(default)s.")
+    a.add_argument("--throttle-rate", type=float, default=0.0,
+                   help="Probability that a download is refused with a 429. Defaults to %(default)s.")
+    a.add_argument("--cdn-host", type=str, default=None,
+                   help="Redirect downloads to this other name for the server, such as localhost, "
+                        "as CurseForge redirects them to its CDN. Downloads stay on the same host by default.")
+    a.add_argument("--dead-file-rate", type=float, default=0.05,
+                   help="Fraction of mods whose manifest file 404s. Defaults to %(default)s.")
+    a.add_argument("--mod-size", type=int, default=256 * 1024,
+                   help="Size of each mod in bytes. Defaults to %(default)s.")
+    a.add_argument("--jobs", type=int, default=None, help="Passed to mccdl as --jobs.")
+    a.add_argument("--work-dir", type=str, default=None,
+                   help="Directory for the cache and MultiMC instances. A temporary directory by default.")
+    a.add_argument("--json", type=str, default=None, help="Also write the results to this JSON file.")
+    a.add_argument("mccdl_args", nargs=argparse.REMAINDER,
+                   help="Extra arguments for mccdl, after a --.")
+    args = a.parse_args()
+    mccdl_args = args.mccdl_args[1:] if args.mccdl_args[:1] == ["--"] else args.mccdl_args
+
+    server = FakeCurseForgeServer(
+        latency=args.latency, bandwidth=args.bandwidth, failure_rate=args.failure_rate,
+        dead_file_rate=args.dead_file_rate, mod_size=args.mod_size, throttle_rate=args.throttle_rate,
+        cdn_host=args.cdn_host
+    ).start()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="mccdl-bench-")
+    benchmark = MccdlBenchmark(server, work_dir, jobs=args.jobs, mccdl_args=mccdl_args)
+
+    print("{:>6} {:<14} {:>6} {:>9} {:>11} {:>9} {:>10} {:>10}".format(
+        "mods", "scenario", "exit", "wall (s)", "served (MiB)", "requests", "MiB/s", "RSS (MiB)"
+    ))
+    results = list()
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            for result in benchmark.run_size(size):
+                print(format_result(result))
+                results.append(result)
+    finally:
+        server.stop()
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            f.write(json.dumps([r._asdict() for r in results], indent=2))
+    return 1 if any(r.exit_status != 0 for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017 John Koelndorfer
+#
+# This file is part of mccdl.
+#
+# mccdl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mccdl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with mccdl.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks mccdl startup, for scripts that run it many times in a row.
+
+Each of these is run in a fresh process several times, and the best and median wall
+times are reported:
+
+    import          python -c "import mccdl"
+    help            mccdl --help
+    warm-upgrade    a no-change upgrade of an installed pack with a fully warm cache
+
+The heavy dependencies loaded by each run are reported too. Importing mccdl or doing a
+warm upgrade must not load the network stack; if it does, the exit status is 1.
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_curseforge import FakeCurseForgeServer
+from run_benchmarks import DRIVER, REPO_DIR
+
+
+HEAVY_MODULES = ("requests", "urllib3", "bs4", "appdirs", "http.server")
+
+# Modules that must not be imported by the scenarios that can be served from the cache.
+NETWORK_MODULES = ("requests", "urllib3", "bs4")
+
+# Reports which heavy modules were imported on stderr, when the process exits.
+REPORT_IMPORTS = """
+import atexit
+import sys
+atexit.register(lambda: sys.stderr.write(
+    "imported: " + ",".join(m for m in {!r} if m in sys.modules) + "\\n"
+))
+""".format(HEAVY_MODULES)
+
+IMPORT_DRIVER = REPORT_IMPORTS + """
+sys.path.insert(0, sys.argv[1])
+import mccdl
+"""
+
+REPORTING_DRIVER = REPORT_IMPORTS + DRIVER
+
+
+class StartupBenchmark:
+    def __init__(self, server, work_dir, runs):
+        self.runs = runs
+        self.server = server
+        self.work_dir = work_dir
+
+    @property
+    def url(self):
+        return "{}/projects/{}".format(self.server.base_url, self.server.pack_project_id(10))
+
+    def common_args(self):
+        return [
+            "-c", os.path.join(self.work_dir, "cache"),
+            "--multimc-directory", os.path.join(self.work_dir, "multimc"), "-l", "error"
+        ]
+
+    def prepare(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        os.makedirs(os.path.join(self.work_dir, "multimc", "icons"))
+        status, _, _ = self.run_once(REPORTING_DRIVER, self.common_args() + [self.url, "bench"])
+        if status != 0:
+            raise RuntimeError("Installing the benchmark pack failed with status {}".format(status))
+
+    def run_scenarios(self):
+        scenarios = (
+            ("import", IMPORT_DRIVER, []),
+            ("help", REPORTING_DRIVER, ["--help"]),
+            ("warm-upgrade", REPORTING_DRIVER, self.common_args() + ["--upgrade", self.url, "bench"]),
+        )
+        for name, driver, args in scenarios:
+            times = list()
+            for _ in range(self.runs):
+                status, wall_time, imported = self.run_once(driver, args)
+                if status != 0:
+                    raise RuntimeError("{} failed with status {}".format(name, status))
+                times.append(wall_time)
+            yield name, min(times), statistics.median(times), imported
+
+    def run_once(self, driver, args):
+        started = time.monotonic()
+        process = subprocess.run(
+            [sys.executable, "-c", driver, REPO_DIR, self.server.base_url, self.server.forge_configuration_site] + args,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True
+        )
+        wall_time = time.monotonic() - started
+        imported = set()
+        for line in process.stderr.splitlines():
+            if line.startswith("imported: "):
+                imported = set(m for m in line[len("imported: "):].split(",") if m)
+        return process.returncode, wall_time, imported
+
+
+def main():
+    a = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    a.add_argument("--runs", type=int, default=10,
+                   help="Number of runs of each scenario. Defaults to %(default)s.")
+    a.add_argument("--work-dir", type=str, default=None,
+                   help="Directory for the cache and MultiMC instances. A temporary directory by default.")
+    args = a.parse_args()
+
+    server = FakeCurseForgeServer().start()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="mccdl-startup-")
+    benchmark = StartupBenchmark(server, work_dir, args.runs)
+
+    print("{:<14} {:>9} {:>11}  {}".format("scenario", "best (s)", "median (s)", "imported"))
+    leaked = False
+    try:
+        benchmark.prepare()
+        for name, best, median, imported in benchmark.run_scenarios():
+            print("{:<14} {:>9.3f} {:>11.3f}  {}".format(name, best, median, ", ".join(sorted(imported)) or "-"))
+            if name != "help" and imported.intersection(NETWORK_MODULES):
+                leaked = True
+    finally:
+        server.stop()
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if leaked:
+        print("The network stack was imported by a run that should not need it", file=sys.stderr)
+    return 1 if leaked else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,28 +18,45 @@
 # along with mccdl.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-from collections import namedtuple
-from distutils.dir_util import copy_tree
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import errno
+import filecmp
 from functools import reduce
 import hashlib
 import json
 import logging
 import os
-from urllib.parse import unquote as urlunquote, urljoin as _urljoin
+from urllib.parse import quote as urlquote, unquote as urlunquote, urljoin as _urljoin, urlsplit
+import random
 import re
 import shutil
+import sqlite3
 import sys
+import tempfile
 import textwrap
+import threading
+import time
 import zipfile
+import zlib
 
-import appdirs
-from bs4 import BeautifulSoup
-import requests
+# appdirs, bs4 and requests are imported where they are needed, so that runs which only
+# use the cache start quickly and never load the network stack.
 
 
 CurseForgeModPackFile = namedtuple("CurseForgeModPackFile", ("project_id", "file_id", "required"))
 CurseForgeFileListing = namedtuple("CurseForgeFileListing", ("project_id", "file_id", "game_version"))
+InstalledFile = namedtuple("InstalledFile", ("project_id", "file_id", "path", "sha256", "size", "mtime_ns"))
+CachedFile = namedtuple("CachedFile", ("url", "filename", "sha256", "size", "path"))
+PlannedDownload = namedtuple(
+    "PlannedDownload", ("key", "modpack_file", "file_id", "url", "filename", "size", "cached", "error")
+)
+CacheIndexEntry = namedtuple(
+    "CacheIndexEntry",
+    ("url", "filename", "sha256", "size", "project_id", "fetched_at", "last_access",
+     "etag", "last_modified", "validated_at")
+)
 
 
 def logger(obj):
@@ -56,54 +73,517 @@ def urljoin(base, *parts):
     return reduce(lambda base, part: _urljoin(base + "/", str(part).lstrip("/")), parts, base)
 
 
+def read_chunks(f, chunk_size=1024 * 1024):
+    """
+    Yields the rest of the binary file f in chunks. The chunks are memoryviews of a single
+    buffer that is reused for every chunk, so each is only valid until the next is read.
+    """
+    view = memoryview(bytearray(chunk_size))
+    while True:
+        n = f.readinto(view)
+        if not n:
+            return
+        yield view[:n]
+
+
+def sha256_file(path, chunk_size=1024 * 1024, digest=None):
+    """
+    Returns the hex SHA-256 digest of the file at path. If a hashlib digest is given, the
+    file's content is added to it instead of to a new one.
+    """
+    digest = digest if digest is not None else hashlib.sha256()
+    with open(path, "rb", buffering=0) as f:
+        for chunk in read_chunks(f, chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_file(source, destination):
+    """
+    Copies the file source to destination, letting the kernel move the bytes where it can.
+
+    os.copy_file_range() is tried first. It never copies through user space, and on
+    filesystems such as XFS, btrfs and NFS it may share extents or copy on the server.
+    Where it is unavailable or refused, shutil.copyfile() is used, which uses sendfile()
+    on Linux and fcopyfile() on macOS.
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                size = os.fstat(src.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            # Some filesystems, such as procfs, report files of unknown size as empty; those
+            # get a plain copy, which reads until the end of the file.
+            if copied == size and size > 0:
+                return destination
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.EBADF):
+                raise
+    shutil.copyfile(source, destination)
+    return destination
+
+
+def parse_size(size):
+    """
+    Parses a human friendly size such as "512M" or "20G" into a number of bytes.
+    """
+    match = re.match(r"^\s*([0-9]+(?:\.[0-9]+)?)\s*([KMGT]?)i?B?\s*$", size, re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError("{} is not a valid size".format(size))
+    multiplier = 1024 ** " KMGT".index(match.group(2).upper() or " ")
+    return int(float(match.group(1)) * multiplier)
+
+
+def parse_count(count):
+    """
+    Parses a count of something, which may be zero but not negative.
+    """
+    if not count.strip().isdigit():
+        raise argparse.ArgumentTypeError("{} is not a valid count".format(count))
+    return int(count)
+
+
+def format_size(size):
+    """
+    Formats a number of bytes for humans, e.g. 1536 becomes "1.5 KiB".
+    """
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(size) < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TiB"
+    return "{:.1f} {}".format(size, unit) if unit != "B" else "{} B".format(size)
+
+
+class Tracer:
+    """
+    Records how long each phase of a run takes, along with counters such as bytes
+    transferred and cache hits, so that slow runs can be diagnosed after the fact.
+
+    Every timed phase is also kept as an individual event, which gives per-file latencies
+    for phases such as fetch. Phase totals are summed across threads, so with concurrent
+    downloads they can exceed the wall time of the run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self.counters = dict()
+        self.events = list()
+        self.phases = dict()
+
+    @contextmanager
+    def phase(self, name, **details):
+        """
+        Times the body of a with statement as one occurrence of phase name. The dict
+        yielded may be updated with extra details to record with the event.
+        """
+        event = dict(details)
+        start = time.monotonic()
+        try:
+            yield event
+        except BaseException as e:
+            event["error"] = str(e) or e.__class__.__name__
+            raise
+        finally:
+            duration = time.monotonic() - start
+            event.update(phase=name, start=start - self._started, duration=duration)
+            with self._lock:
+                totals = self.phases.setdefault(name, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+                totals["count"] += 1
+                totals["total_seconds"] += duration
+                totals["max_seconds"] = max(totals["max_seconds"], duration)
+                self.events.append(event)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "wall_seconds": time.monotonic() - self._started,
+                "phases": dict((k, dict(v)) for k, v in self.phases.items()),
+                "counters": dict(self.counters),
+                "events": sorted(self.events, key=lambda e: e["start"]),
+            }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            f.write(json.dumps(self.to_dict(), indent=2, sort_keys=True))
+
+
+class ThreadProfiler:
+    """
+    cProfile wrapper that also profiles threads started while it is running.
+
+    Before Python 3.12, cProfile only profiles the thread that enabled it; every other
+    thread gets its own profiler here, and all of them are merged when the results are
+    written out. From 3.12 on, cProfile uses sys.monitoring, which is process-wide: a
+    single profiler already sees every thread, and a second one cannot be enabled. Its
+    primitive call counts are unreliable when threads interleave, but total call counts and
+    times are not.
+    """
+
+    PER_THREAD = sys.version_info < (3, 12)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profilers = list()
+
+    def runcall(self, func, *args, **kwargs):
+        if not self.PER_THREAD:
+            return self._new_profiler().runcall(func, *args, **kwargs)
+        threading.setprofile(self._profile_thread)
+        try:
+            return self._new_profiler().runcall(func, *args, **kwargs)
+        finally:
+            threading.setprofile(None)
+
+    def dump_stats(self, path):
+        import pstats
+        with self._lock:
+            profilers = list(self._profilers)
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(path)
+
+    def _new_profiler(self):
+        import cProfile
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._profilers.append(profiler)
+        return profiler
+
+    def _profile_thread(self, *args):
+        # Called on the first profile event of each new thread; hand over to cProfile.
+        sys.setprofile(None)
+        self._new_profiler().enable()
+
+
+class StagePipeline:
+    """
+    Runs the independent stages of a modpack setup concurrently.
+
+    Use it as a context manager and submit() each stage as soon as its inputs are ready.
+    When a stage fails, the pipeline is cancelled: stages that have not started yet are
+    skipped, and running stages that check cancelled stop early. Leaving the with block
+    waits for every stage and raises the first failure.
+    """
+    DEFAULT_WORKERS = 4
+
+    def __init__(self, tracer=None, max_workers=DEFAULT_WORKERS):
+        self.cancelled = threading.Event()
+        self.logger = logger(self)
+        self.tracer = tracer if tracer is not None else Tracer()
+        self._error = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = list()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.cancel()
+            self.close()
+            return False
+        self.wait()
+
+    def submit(self, name, func, *args, **kwargs):
+        """
+        Starts running func(*args, **kwargs) as stage name, returning a Future for its result.
+        """
+        def run_stage():
+            if self.cancelled.is_set():
+                raise StageCancelledError("Stage {} was cancelled".format(name))
+            with self.tracer.phase("stage", stage=name):
+                try:
+                    return func(*args, **kwargs)
+                except BaseException as e:
+                    self._fail(name, e)
+                    raise
+
+        future = self._executor.submit(run_stage)
+        self._futures.append(future)
+        return future
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self):
+        """
+        Waits for every stage to finish, then raises the first failure, if any.
+        """
+        self.close()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def _fail(self, name, e):
+        with self._lock:
+            if self._error is None and not isinstance(e, StageCancelledError):
+                self.logger.debug("Stage %s failed, cancelling the remaining stages: %s", name, e)
+                self._error = e
+        self.cancel()
+
+
 class CurseForgeClient:
     CURSE_HOSTNAME = "minecraft.curseforge.com"
     CURSE_BASE_URL = "http://" + CURSE_HOSTNAME
-    DEFAULT_CACHE_DIR = appdirs.user_cache_dir("mccdl")
-
-    def __init__(self, instance_manager, downloader, unpacker):
+    DEFAULT_JOBS = 4
+    DEFAULT_MUTABLE_TTL = 60 * 60
+
+    def __init__(self, instance_manager, downloader, unpacker, session, jobs=DEFAULT_JOBS,
+                 mutable_ttl=DEFAULT_MUTABLE_TTL, file_listings=None, tracer=None, override_sync=None,
+                 reconcile=None, curse_base_url=None, forge_meta_url=None, resolve_sizes=False):
+        """
+        curse_base_url and forge_meta_url replace the upstream CurseForge site and MultiMC
+        Forge metadata site, for example with an mccdl mirror.
+
+        If resolve_sizes is True, the size of every file to be downloaded is looked up
+        before any download starts, so that the largest files can be started first.
+        """
+        self.curse_base_url = curse_base_url if curse_base_url is not None else self.CURSE_BASE_URL
         self.downloader = downloader
+        self.forge_meta_url = forge_meta_url
+        self.file_listings = file_listings if file_listings is not None else CurseForgeFileListingCache()
         self.instance_manager = instance_manager
+        self.jobs = max(1, jobs)
         self.logger = logger(self)
+        self.mutable_ttl = mutable_ttl
+        self.override_sync = override_sync if override_sync is not None else OverrideSynchronizer()
+        self.reconciler = ModsDirectoryReconciler(self, reconcile) if reconcile not in (None, "none") else None
+        self.resolve_sizes = resolve_sizes
+        self.session = session
+        self.tracer = tracer if tracer is not None else Tracer()
         self.unpacker = unpacker
 
+    @classmethod
+    def default_cache_dir(cls):
+        import appdirs
+        return appdirs.user_cache_dir("mccdl")
+
     def install_modpack(self, project_id, file_id, instance_name):
         self._setup_modpack("install", project_id, file_id, instance_name)
 
     def upgrade_modpack(self, project_id, file_id, instance_name):
         self._setup_modpack("upgrade", project_id, file_id, instance_name)
 
+    def prefetch_modpacks(self, modpacks):
+        """
+        Fills the download cache with everything needed to install each of modpacks, a list
+        of (project_id, file_id) tuples, without creating any MultiMC instance. Returns a list
+        of (modpack, exception) tuples where exception is None for modpacks that were fetched
+        completely.
+
+        This includes the modpack itself, its icon, its Forge patch and every file in its
+        manifest. Files shared between modpacks are fetched once.
+        """
+        errors = dict()
+        modpack_manifests = dict()
+
+        def prefetch_modpack(project_id, file_id):
+            project = self.project(project_id)
+            modpack = project.download_modpack(file_id, extract=self.override_sync.link)
+            project.fetch_icon()
+            self.downloader.fetch(MultiMcInstance.forge_config_url(modpack.forge_version, self.forge_meta_url))
+            return modpack
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [(m, executor.submit(prefetch_modpack, *m)) for m in modpacks]
+            for m, future in futures:
+                try:
+                    modpack_manifests[m] = future.result()
+                except Exception as e:
+                    self.logger.error("Failed to prefetch modpack %s, file %s: %s", str(m[0]), str(m[1]), e)
+                    errors[m] = e
+
+        wanted_files = dict()
+        for modpack in modpack_manifests.values():
+            for modpack_file in modpack.files():
+                wanted_files[self._fetch_key(modpack_file, modpack.minecraft_version)] = modpack_file
+        cached_files, fetch_errors = self._fetch_many(wanted_files)
+
+        for m, modpack in modpack_manifests.items():
+            keys = [(f, self._fetch_key(f, modpack.minecraft_version)) for f in modpack.files()]
+            failed_files = [(f, fetch_errors[key]) for f, key in keys if key in fetch_errors]
+            if failed_files:
+                errors[m] = ModpackDownloadError(failed_files)
+        return [(m, errors.get(m)) for m in modpacks]
+
     def project(self, project_id):
         return CurseForgeProject(self, project_id)
 
     def url_for(self, *path):
-        return urljoin(self.CURSE_BASE_URL, *path)
+        return urljoin(self.curse_base_url, *path)
 
     def _setup_modpack(self, mode, project_id, file_id, instance_name):
-        assert mode in ("install", "upgrade")
-        action = {"install": "Installing", "upgrade": "Upgrading"}.get(mode)
-
-        self.logger.info("%s modpack %s in instance %s, file ID %s",
-                         action, str(project_id), instance_name, str(file_id))
-
-        project = self.project(project_id)
-        modpack_extract_dir = project.download_and_unpack_file(file_id)
-        modpack = CurseForgeModPack(modpack_extract_dir)
-
-        instance = self.instance_manager.instance(instance_name)
-        setup_method = {"install": instance.create, "upgrade": instance.upgrade}.get(mode)
-        setup_args = [modpack.minecraft_version, modpack.forge_version]
-        if mode == "install":
-            project_icon = project.download_icon()
-            setup_args.append(project_icon)
-        setup_method(*setup_args)
-
-        for modpack_file in modpack.files():
-            self.project(modpack_file.project_id).download_file(
-                modpack_file.file_id, instance.mods_directory, game_version=modpack.minecraft_version
+        setup = ModpackSetup(self, mode, project_id, file_id, instance_name)
+        with StagePipeline(self.tracer) as pipeline:
+            setup.prepare(pipeline)
+            # The instance is set up and the modpack overrides installed while the files
+            # are being downloaded.
+            fetch = pipeline.submit(
+                "fetch_files", self.fetch_modpack_files, setup.files_to_fetch, setup.modpack.minecraft_version,
+                pipeline.cancelled
             )
-        self.logger.info("Installing modpack overrides")
-        modpack.install_overrides(instance.minecraft_directory)
+            pipeline.submit("setup_instance", setup.setup_instance)
+        setup.finish(fetch.result())
+
+    def setup_modpacks(self, setups):
+        """
+        Runs several ModpackSetups together, returning a list of (setup, exception) tuples
+        where exception is None for setups that succeeded.
+
+        All setups are prepared concurrently. Then every file that any of them needs is
+        fetched exactly once, sharing the same self.jobs workers, while the instances are
+        set up. Finally each setup is finished. A failing setup does not stop the others.
+        """
+        errors = dict()
+        pipelines = dict((setup, StagePipeline(self.tracer)) for setup in setups)
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [(setup, executor.submit(setup.prepare, pipelines[setup])) for setup in setups]
+            for setup, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error("Failed to prepare instance %s: %s", setup.instance_name, e)
+                    errors[setup] = e
+                    pipelines[setup].cancel()
+                    pipelines[setup].close()
+
+        prepared_setups = [setup for setup in setups if setup not in errors]
+        for setup in prepared_setups:
+            pipelines[setup].submit("setup_instance", setup.setup_instance)
+        wanted_files = self.wanted_files(prepared_setups)
+        self.logger.info("%d instances need %d distinct files", len(prepared_setups), len(wanted_files))
+        cached_files, fetch_errors = self._fetch_many(wanted_files)
+
+        for setup in prepared_setups:
+            try:
+                pipelines[setup].wait()
+            except Exception as e:
+                self.logger.error("Failed to set up instance %s: %s", setup.instance_name, e)
+                errors[setup] = e
+                continue
+            game_version = setup.modpack.minecraft_version
+            keys = [(f, self._fetch_key(f, game_version)) for f in setup.files_to_fetch]
+            failed_files = [(f, fetch_errors[key]) for f, key in keys if key in fetch_errors]
+            if failed_files:
+                errors[setup] = ModpackDownloadError(failed_files)
+                continue
+            try:
+                setup.finish(dict((f, cached_files[key]) for f, key in keys))
+            except Exception as e:
+                self.logger.error("Failed to finish instance %s: %s", setup.instance_name, e)
+                errors[setup] = e
+
+        return [(setup, errors.get(setup)) for setup in setups]
+
+    def wanted_files(self, setups):
+        """
+        Returns a dict mapping keys from _fetch_key() to the CurseForgeModPackFiles that
+        the given, resolved ModpackSetups need fetched. Files needed by several setups are
+        listed once.
+        """
+        wanted_files = dict()
+        for setup in setups:
+            for modpack_file in setup.files_to_fetch:
+                wanted_files[self._fetch_key(modpack_file, setup.modpack.minecraft_version)] = modpack_file
+        return wanted_files
+
+    def plan_downloads(self, wanted_files, resolve=True):
+        """
+        Works out, for each of wanted_files (as for _fetch_many()), which file will be fetched,
+        from which URL, how big it is and whether it is already cached, returning a DownloadPlan.
+
+        If resolve is True, files that are not cached are resolved with HEAD requests, using
+        up to self.jobs concurrent workers. Otherwise their name and size are left unknown.
+        A file that cannot be resolved is planned with its error, and fetching it is left
+        to be attempted (and reported) as usual.
+        """
+        def plan(item):
+            key, modpack_file = item
+            project_id, file_id, game_version = key
+            try:
+                return self.project(project_id).plan_file(key, modpack_file, resolve)
+            except Exception as e:
+                self.logger.debug("Could not resolve project %s, file %s: %s", str(project_id), str(file_id), e)
+                return PlannedDownload(key, modpack_file, file_id, None, None, None, False, e)
+
+        with self.tracer.phase("plan", files=len(wanted_files)):
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                plan = DownloadPlan(list(executor.map(plan, wanted_files.items())))
+        self.logger.info(
+            "Planned %d files: %d cached, %d to download (%s), %d unresolved", len(plan.downloads),
+            len(plan.hits), len(plan.misses), format_size(plan.download_size), len(plan.errors)
+        )
+        return plan
+
+    def fetch_modpack_files(self, modpack_files, game_version=None, cancelled=None):
+        """
+        Fetches each of the given modpack files into the download cache using up to
+        self.jobs concurrent workers, returning a dict mapping each CurseForgeModPackFile
+        to its CachedFile.
+
+        A failure to download one file does not stop the others. Once every file
+        has been attempted, a ModpackDownloadError describing all failures is raised.
+        Files that have not been started when the threading.Event cancelled is set are
+        not downloaded at all.
+        """
+        wanted_files = dict((self._fetch_key(f, game_version), f) for f in modpack_files)
+        cached_files, fetch_errors = self._fetch_many(wanted_files, cancelled)
+        if fetch_errors:
+            raise ModpackDownloadError([(wanted_files[key], e) for key, e in fetch_errors.items()])
+        return dict((f, cached_files[key]) for key, f in wanted_files.items())
+
+    def _fetch_many(self, wanted_files, cancelled=None):
+        """
+        Fetches the modpack files in wanted_files, a dict mapping keys from _fetch_key() to
+        CurseForgeModPackFiles. Returns a dict of CachedFiles and a dict of exceptions, both
+        keyed the same way.
+
+        The downloads are planned first. With self.resolve_sizes, that includes looking up
+        their sizes, so that the largest ones can be started first.
+        """
+        plan = self.plan_downloads(wanted_files, self.resolve_sizes)
+        self.logger.info("Downloading %d modpack files using %d jobs", len(plan.downloads) - len(plan.hits), self.jobs)
+
+        def fetch(planned):
+            project_id, _, game_version = planned.key
+            if cancelled is not None and cancelled.is_set():
+                raise StageCancelledError("Download cancelled")
+            return self.project(project_id).fetch_file(planned.file_id, game_version)
+
+        cached_files = dict()
+        errors = dict()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [(planned.key, executor.submit(fetch, planned)) for planned in plan.schedule()]
+            for key, future in futures:
+                try:
+                    cached_files[key] = future.result()
+                except Exception as e:
+                    if not isinstance(e, StageCancelledError):
+                        self.logger.error("Failed to download project %s, file %s: %s", str(key[0]), str(key[1]), e)
+                    errors[key] = e
+        return (cached_files, errors)
+
+    @classmethod
+    def _fetch_key(cls, modpack_file, game_version):
+        # The game version is part of the key because it decides which file replaces
+        # a file that no longer exists.
+        return (modpack_file.project_id, modpack_file.file_id, game_version)
 
     def url_to_project_and_file(self, url):
         # Each entry in this list contains a regular expression matching a Curse
@@ -130,45 +610,276 @@ class CurseForgeClient:
         return (project_id, file_id)
 
 
+class DownloadPlan:
+    """
+    The PlannedDownloads for a set of modpack files.
+    """
+
+    def __init__(self, downloads):
+        self.downloads = downloads
+
+    @property
+    def hits(self):
+        return [d for d in self.downloads if d.cached]
+
+    @property
+    def misses(self):
+        """
+        Planned downloads of files that are not cached, not counting unresolved files.
+        """
+        return [d for d in self.downloads if not d.cached and d.error is None]
+
+    @property
+    def errors(self):
+        return [d for d in self.downloads if d.error is not None]
+
+    @property
+    def download_size(self):
+        """
+        Total size of the files to be downloaded, not counting those of unknown size.
+        """
+        return sum(d.size for d in self.misses if d.size is not None)
+
+    def schedule(self):
+        """
+        Returns the planned downloads in the order they should be started: files to be
+        downloaded before cached files, largest first so that the biggest downloads are
+        not left to run on their own at the end. Files of unknown size go first.
+        """
+        return sorted(self.downloads, key=lambda d: (d.cached, -(d.size if d.size is not None else float("inf"))))
+
+
+class ModpackSetup:
+    """
+    Installs or upgrades one modpack in one MultiMC instance.
+
+    This happens in steps so that several setups can share their downloads, and so that
+    the downloads can overlap with the rest of the work. prepare() fetches the modpack and
+    works out which of the modpack's files need to be fetched. setup_instance() creates or
+    upgrades the instance and installs the modpack's overrides while those files are being
+    fetched. finish() installs the files and writes the instance lockfile.
+
+    Overrides take precedence over the modpack's files: a file that is also shipped as an
+    override is left to the override and not recorded in the lockfile.
+
+    resolve(), the part of prepare() that works out what to do, does not change the
+    instance and can be used on its own for a dry run.
+    """
+
+    def __init__(self, client, mode, project_id, file_id, instance_name):
+        assert mode in ("install", "upgrade")
+        self.client = client
+        self.file_id = file_id
+        self.instance_name = instance_name
+        self.logger = logger(self)
+        self.mode = mode
+        self.project_id = project_id
+
+        self.instance = None
+        self.modpack = None
+        self.files_to_fetch = None
+        self.kept_files = None
+        self.stale_files = None
+        self._icon = None
+        self._override_paths = None
+
+    def resolve(self):
+        action = {"install": "Installing", "upgrade": "Upgrading"}.get(self.mode)
+        self.logger.info("%s modpack %s in instance %s, file ID %s",
+                         action, str(self.project_id), self.instance_name, str(self.file_id))
+
+        project = self.client.project(self.project_id)
+        self.modpack = project.download_modpack(self.file_id, extract=self.client.override_sync.link)
+
+        self.instance = self.client.instance_manager.instance(self.instance_name)
+        previous_lockfile = self.instance.read_lockfile() if self.mode == "upgrade" else None
+        self._plan_files(previous_lockfile)
+
+    def prepare(self, pipeline):
+        """
+        Resolves this setup, fetching the modpack icon and Forge patch as separate stages
+        of pipeline in the meantime.
+        """
+        if self.mode == "install":
+            self._icon = pipeline.submit("fetch_icon", self.client.project(self.project_id).fetch_icon)
+        self.resolve()
+        pipeline.submit(
+            "fetch_forge_patch", self.client.downloader.fetch,
+            MultiMcInstance.forge_config_url(self.modpack.forge_version, self.client.forge_meta_url)
+        )
+        # This has to happen before the instance is set up: upgrading an instance without
+        # a lockfile empties its mods directory.
+        if self.client.reconciler is not None:
+            self.client.reconciler.reconcile(self.instance, self.files_to_fetch, self.modpack.minecraft_version)
+
+    def setup_instance(self):
+        setup_method = {"install": self.instance.create, "upgrade": self.instance.upgrade}.get(self.mode)
+        setup_args = [self.modpack.minecraft_version, self.modpack.forge_version]
+        if self.mode == "install":
+            setup_args.append(self.client.downloader.materialize(self._icon.result()))
+        setup_method(*setup_args)
+
+        # Stale files go before the overrides are installed: an override may replace a mod
+        # that was dropped from the manifest with an identical file at the same path.
+        for stale_file in self.stale_files:
+            self.instance.remove_installed_file(stale_file)
+
+        self.logger.info("Installing modpack overrides")
+        with self.client.tracer.phase("overrides", instance=self.instance_name):
+            self.modpack.install_overrides(self.instance.minecraft_directory, self.client.override_sync)
+
+    def finish(self, cached_files):
+        """
+        Completes the setup, given a dict mapping each of self.files_to_fetch to its CachedFile.
+        """
+        override_paths = self.override_paths()
+        installed_files = [
+            f for f in self.kept_files
+            if os.path.abspath(os.path.join(self.instance.directory, f.path)) not in override_paths
+        ]
+        for modpack_file in self.files_to_fetch:
+            cached_file = cached_files[modpack_file]
+            path = os.path.abspath(os.path.join(self.instance.mods_directory, cached_file.filename))
+            if path in override_paths:
+                self.logger.info("Not installing %s, the modpack overrides it", path)
+                continue
+            path = self.client.downloader.materialize(cached_file, self.instance.mods_directory)
+            installed_files.append(self.instance.installed_file(modpack_file, cached_file, path))
+        self.instance.write_lockfile(InstanceLockfile(self.modpack.manifest, installed_files))
+
+    def override_paths(self):
+        """
+        Returns the set of absolute paths in the instance that the modpack's overrides install.
+        """
+        if self._override_paths is None:
+            destination = os.path.abspath(self.instance.minecraft_directory)
+            self._override_paths = set(
+                os.path.abspath(os.path.join(destination, p)) for p in self.modpack.override_paths()
+            )
+        return self._override_paths
+
+    def _plan_files(self, previous_lockfile):
+        # Files that are unchanged since previous_lockfile was written are left alone and
+        # files that are no longer part of the modpack are removed. Files mccdl did not
+        # install are never touched.
+        previous_files = previous_lockfile.files_by_modpack_file() if previous_lockfile is not None else dict()
+        self.kept_files = list()
+        self.files_to_fetch = list()
+        for modpack_file in self.modpack.files():
+            previous_file = previous_files.get((modpack_file.project_id, modpack_file.file_id))
+            if previous_file is not None and self.instance.installed_file_intact(previous_file):
+                self.kept_files.append(previous_file)
+            else:
+                self.files_to_fetch.append(modpack_file)
+
+        kept_paths = set(f.path for f in self.kept_files)
+        self.stale_files = [f for f in previous_files.values() if f.path not in kept_paths]
+        self.logger.info("Instance %s: keeping %d unchanged files, removing %d, installing %d", self.instance_name,
+                         len(self.kept_files), len(self.stale_files), len(self.files_to_fetch))
+
+
 class CurseForgeProject:
     def __init__(self, client, project_id):
         self._client = client
         self.logger = logger(self)
         self.project_id = project_id
 
-    def download_and_unpack_file(self, file_id):
-        archive_path = self.download_file(file_id)
-        unpack_directory = self._client.unpacker.unpack(archive_path)
-        return unpack_directory
-
-    def download_file(self, file_id, destination=None, game_version=None):
+    def download_modpack(self, file_id, extract=False):
+        """
+        Downloads a modpack file, returning a CurseForgeArchiveModPack that reads it in place.
+
+        If extract is True, the modpack is extracted (or an earlier extraction of the same
+        archive is reused) and a CurseForgeModPack for the extracted tree is returned instead.
+        """
+        cached_file = self.fetch_file(file_id)
+        if extract:
+            return CurseForgeModPack(self._client.unpacker.unpack(cached_file.path, cached_file.sha256))
+        return CurseForgeArchiveModPack(cached_file.path)
+
+    def fetch_file(self, file_id, game_version=None):
+        """
+        Ensures that a file of this project is in the download cache, returning its CachedFile.
+
+        If the file no longer exists, the next file published for the same game version
+        is fetched instead.
+        """
         self.logger.info("Fetching project %s, file %s", str(self.project_id), str(file_id))
+        # "latest" always has the same URL but points at whichever file was most recently
+        # published, so its cached copy has to be revalidated from time to time.
+        max_age = self._client.mutable_ttl if file_id == "latest" else None
         try:
-            file_path = self._client.downloader.download(self.file_url(file_id), destination)
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 404:
-                # A file disappeared on Curse, or maybe the modpack author screwed up.
-                # Let's try to get the next available file.
-                next_file = self._next_file_after(file_id, game_version)
-                self.logger.warn("Could not find file %s for project %s, getting file %d instead",
-                                 file_id, self.project_id, next_file.file_id)
-                file_path = self._client.downloader.download(self.file_url(next_file.file_id), destination)
-            else:
-                raise e
-        return file_path
-
-    def download_icon(self):
-        response = requests.get(self.url_for())
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
+            cached_file = self._client.downloader.fetch(self.file_url(file_id), self.project_id, max_age)
+        except DownloadNotFoundError:
+            # A file disappeared on Curse, or maybe the modpack author screwed up.
+            # Let's try to get the next available file.
+            next_file = self._next_file_after(file_id, game_version)
+            self.logger.warn("Could not find file %s for project %s, getting file %d instead",
+                             file_id, self.project_id, next_file.file_id)
+            cached_file = self._client.downloader.fetch(self.file_url(next_file.file_id), self.project_id)
+        return cached_file
+
+    def plan_file(self, key, modpack_file, resolve=True):
+        """
+        Returns a PlannedDownload for a file of this project, without downloading it.
+
+        If resolve is True and the file is not cached, its name and size are looked up. If it
+        no longer exists, the file that fetch_file() would fetch instead is planned.
+        """
+        _, file_id, game_version = key
+        downloader = self._client.downloader
+        url = self.file_url(file_id)
+        cached_file = downloader.cached_file(url)
+        if cached_file is not None:
+            return PlannedDownload(key, modpack_file, file_id, url, cached_file.filename, cached_file.size, True, None)
+        if not resolve:
+            return PlannedDownload(key, modpack_file, file_id, url, None, None, False, None)
+        try:
+            filename, size = downloader.resolve(url)
+        except DownloadNotFoundError:
+            next_file = self._next_file_after(file_id, game_version)
+            self.logger.warn("Could not find file %s for project %s, planning file %d instead",
+                             file_id, self.project_id, next_file.file_id)
+            file_id = next_file.file_id
+            url = self.file_url(file_id)
+            cached_file = downloader.cached_file(url)
+            if cached_file is not None:
+                return PlannedDownload(key, modpack_file, file_id, url, cached_file.filename, cached_file.size,
+                                       True, None)
+            filename, size = downloader.resolve(url)
+        return PlannedDownload(key, modpack_file, file_id, url, filename, size, False, None)
+
+    def fetch_icon(self):
+        # The project page goes through the download cache too, so that instances can be
+        # created offline once the project has been prefetched.
+        page = self._client.downloader.fetch(self.url_for(), self.project_id, self._client.mutable_ttl)
+        from bs4 import BeautifulSoup
+        with open(page.path, "rb") as f:
+            soup = BeautifulSoup(f.read(), "html.parser")
         icon_url = soup.findChild("div", attrs={"class": "avatar-wrapper"}).findChild("img").get("src")
 
-        return self._client.downloader.download(icon_url)
+        return self._client.downloader.fetch(icon_url, project_id=self.project_id)
 
     def _files(self, game_version=None):
-        response = requests.get(self.url_for("files"))
+        files = self._client.file_listings.get(self.project_id, self._fetch_files)
+
+        if game_version is not None:
+            files_matching_version = [f for f in files if f.game_version == game_version]
+        else:
+            files_matching_version = files
+
+        self.logger.debug(
+            "Project %s has files: %s", self.project_id,
+            ", ".join((str(i.file_id) for i in files_matching_version))
+        )
+        return files_matching_version
+
+    def _fetch_files(self):
+        from bs4 import BeautifulSoup, SoupStrainer
+        response = self._client.session.get(self.url_for("files"))
         response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
+        # Only build a tree for the file list rows; the rest of the page is never looked at.
+        only_file_rows = SoupStrainer("tr", attrs={"class": "project-file-list-item"})
+        soup = BeautifulSoup(response.text, "html.parser", parse_only=only_file_rows)
 
         # All file links share the same class overflow-tip.
         #
@@ -180,17 +891,7 @@ class CurseForgeProject:
             file_id = int(file_link.split("/")[-1])
             file_game_version = fe.findChild("span", attrs={"class": "version-label"}).text.strip()
             files.append(CurseForgeFileListing(self.project_id, file_id, file_game_version))
-
-        if game_version is not None:
-            files_matching_version = [f for f in files if f.game_version == game_version]
-        else:
-            files_matching_version = files
-
-        self.logger.debug(
-            "Project %s has files: %s", self.project_id,
-            ", ".join((str(i.file_id) for i in files_matching_version))
-        )
-        return files_matching_version
+        return files
 
     def file_url(self, file_id):
         url_parts = ["files", file_id]
@@ -201,35 +902,208 @@ class CurseForgeProject:
         return url
 
     def _next_file_after(self, file_id, game_version=None):
-        file_id = int(file_id)
-        file_id_list = self._files(game_version)
-        return next(filter(lambda i: i.file_id > file_id, sorted(file_id_list)))
+        with self._client.tracer.phase("fallback_lookup", project_id=self.project_id, file_id=file_id):
+            self._client.tracer.count("fallbacks")
+            file_id = int(file_id)
+            file_id_list = self._files(game_version)
+            return next(filter(lambda i: i.file_id > file_id, sorted(file_id_list)))
 
     def url_for(self, *path):
         return self._client.url_for("projects", self.project_id, *path)
 
 
+class CurseForgeFileListingCache:
+    """
+    Caches the parsed file listings of CurseForge projects.
+
+    Listings are kept in memory for the rest of the run and, if a directory is given,
+    on disk for ttl seconds so that later runs can skip fetching and parsing them.
+    Concurrent requests for the same project's listing share a single fetch.
+    """
+    DEFAULT_TTL = 6 * 60 * 60
+
+    def __init__(self, directory=None, ttl=DEFAULT_TTL):
+        self.directory = directory
+        self.logger = logger(self)
+        self.ttl = ttl
+        self._listings = dict()
+        self._locks = dict()
+        self._locks_lock = threading.Lock()
+
+    def get(self, project_id, fetch):
+        """
+        Returns the list of CurseForgeFileListing for project_id, calling fetch() to
+        retrieve it if it is not cached.
+        """
+        project_id = str(project_id)
+        with self._locks_lock:
+            lock = self._locks.setdefault(project_id, threading.Lock())
+        with lock:
+            if project_id not in self._listings:
+                files = self._load(project_id)
+                if files is None:
+                    files = fetch()
+                    self._save(project_id, files)
+                self._listings[project_id] = files
+            return self._listings[project_id]
+
+    def _load(self, project_id):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(project_id), "r") as f:
+                content = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if time.time() - content["fetched_at"] > self.ttl:
+            self.logger.debug("Cached file listing for project %s has expired", project_id)
+            return None
+        return [CurseForgeFileListing(*f) for f in content["files"]]
+
+    def _save(self, project_id, files):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(project_id)
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({"fetched_at": time.time(), "files": [list(i) for i in files]}))
+        os.replace(tmp_path, path)
+
+    def _path(self, project_id):
+        # Project IDs may be slugs taken from a URL; keep them from escaping the directory.
+        return os.path.join(self.directory, hashlib.sha256(project_id.encode("utf-8")).hexdigest() + ".json")
+
+
+class ModsDirectoryReconciler:
+    """
+    Satisfies modpack files from jars that already exist on this machine, so that they
+    do not have to be downloaded.
+
+    Jars in the target instance's mods directory are always considered. With scope "all",
+    jars in every other MultiMC instance are considered too, and the lockfiles of those
+    instances tell us which jar belongs to which project and file. A local jar is used
+    when its SHA-256 matches what a modpack file is known to contain, either from the
+    cache index or from a lockfile. Used jars are adopted into the download cache.
+
+    Jars are never matched by name and size alone: an adopted jar becomes the cached
+    content of its URL for every later install and for mirror clients, so a patched jar
+    or a different build with the same name and size would spread from there.
+    """
+    SCOPES = ("none", "instance", "all")
+
+    def __init__(self, client, scope="instance"):
+        assert scope in self.SCOPES
+        self.client = client
+        self.logger = logger(self)
+        self.scope = scope
+
+    def reconcile(self, instance, modpack_files, game_version=None):
+        """
+        Adopts local files for those of modpack_files that are not cached yet. Returns the
+        number of files adopted.
+        """
+        downloader = self.client.downloader
+        urls = dict((f, self.client.project(f.project_id).file_url(f.file_id)) for f in modpack_files)
+        missing_files = [f for f in modpack_files if not downloader.is_cached(urls[f])]
+        if not missing_files:
+            return 0
+
+        with self.client.tracer.phase("reconcile", instance=instance.name):
+            local_jars = self._local_jars(instance)
+            if not local_jars:
+                return 0
+            known_hashes = self._known_hashes(instance)
+            jars_by_hash = None
+            adopted = 0
+            for modpack_file in missing_files:
+                url = urls[modpack_file]
+                entry = downloader.index.lookup(url)
+                sha256 = entry.sha256 if entry is not None else known_hashes.get(
+                    (modpack_file.project_id, modpack_file.file_id)
+                )
+                if sha256 is None:
+                    continue
+                if jars_by_hash is None:
+                    jars_by_hash = dict((downloader.fingerprint(path), path) for path in local_jars)
+                if sha256 in jars_by_hash:
+                    path = jars_by_hash[sha256]
+                    if downloader.adopt(url, path, os.path.basename(path), sha256, modpack_file.project_id):
+                        adopted += 1
+        self.logger.info("Adopted %d of %d missing files from local jars", adopted, len(missing_files))
+        return adopted
+
+    def _instances(self, instance):
+        instances = [instance]
+        if self.scope == "all":
+            instances_dir = os.path.dirname(instance.directory)
+            try:
+                names = sorted(os.listdir(instances_dir))
+            except FileNotFoundError:
+                names = list()
+            instances.extend(self.client.instance_manager.instance(n) for n in names if n != instance.name)
+        return instances
+
+    def _local_jars(self, instance):
+        jars = list()
+        for i in self._instances(instance):
+            try:
+                entries = list(os.scandir(i.mods_directory))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            jars.extend(e.path for e in entries if e.name.endswith(".jar") and e.is_file(follow_symlinks=False))
+        return jars
+
+    def _known_hashes(self, instance):
+        known_hashes = dict()
+        for i in self._instances(instance):
+            lockfile = i.read_lockfile()
+            if lockfile is not None:
+                known_hashes.update(((f.project_id, f.file_id), f.sha256) for f in lockfile.files)
+        return known_hashes
+
+
 class CurseForgeDownloadUnpacker:
-    def __init__(self, unpack_dir):
+    def __init__(self, unpack_dir, tracer=None):
         self.logger = logger(self)
+        self.tracer = tracer if tracer is not None else Tracer()
         self.unpack_dir = unpack_dir
 
-    def unpack(self, archive_path):
+    def unpack(self, archive_path, archive_key=None):
+        """
+        Extracts archive_path, returning the directory it was extracted to.
+
+        Extracted trees are kept under archive_key (by default, the archive's filename),
+        which should identify the archive's content, e.g. its SHA-256. An archive that
+        was already extracted under the same key is not extracted again.
+        """
+        unpack_destination = self._unpack_destination(archive_key or os.path.basename(archive_path))
+        if os.path.isdir(unpack_destination):
+            self.logger.debug("Archive %s is already unpacked at %s", archive_path, unpack_destination)
+            return unpack_destination
+
         self.logger.debug("Unpacking archive %s", archive_path)
-        unpack_destination = self._unpack_destination(archive_path)
+        os.makedirs(self.unpack_dir, exist_ok=True)
+        tmp_destination = tempfile.mkdtemp(dir=self.unpack_dir, prefix=".unpack-")
         try:
-            shutil.rmtree(unpack_destination)
+            with self.tracer.phase("unpack", archive=archive_path), zipfile.ZipFile(str(archive_path)) as zipf:
+                zipf.extractall(tmp_destination)
+            # Renaming the finished tree into place means a partially extracted archive
+            # is never mistaken for a complete one.
+            os.rename(tmp_destination, unpack_destination)
         except OSError as e:
-            if e.errno != errno.ENOENT:
+            shutil.rmtree(tmp_destination, ignore_errors=True)
+            if not os.path.isdir(unpack_destination):
                 raise e
-        zipf = zipfile.ZipFile(str(archive_path))
-        zipf.extractall(unpack_destination)
+        except BaseException:
+            shutil.rmtree(tmp_destination, ignore_errors=True)
+            raise
         self.logger.debug("Unpacked archive to %s", unpack_destination)
 
         return unpack_destination
 
-    def _unpack_destination(self, archive_path):
-        return os.path.join(self.unpack_dir, os.path.basename(archive_path))
+    def _unpack_destination(self, archive_key):
+        return os.path.join(self.unpack_dir, archive_key)
 
 
 class CurseForgeModPack:
@@ -242,15 +1116,18 @@ class CurseForgeModPack:
         for i in self.manifest["files"]:
             yield CurseForgeModPackFile(i["projectID"], i["fileID"], i["required"])
 
-    def install_overrides(self, destination):
-        # FIXME: distutils.dir_util.copy_tree seems to keep some internal state when it does its copy.
-        #
-        # If the destination directory disappears, copy_tree will not recreate missing path
-        # components.
-        #
-        # In practice this should not be an issue since our script will execute once to install a
-        # modpack, then exit.
-        copy_tree(os.path.join(self.unpack_directory, self.manifest["overrides"]), destination)
+    def install_overrides(self, destination, synchronizer=None):
+        synchronizer = synchronizer if synchronizer is not None else OverrideSynchronizer()
+        return synchronizer.sync_directory(os.path.join(self.unpack_directory, self.manifest["overrides"]), destination)
+
+    def override_paths(self):
+        """
+        Returns the paths of the override files, relative to the instance's minecraft directory.
+        """
+        source = os.path.join(self.unpack_directory, self.manifest["overrides"])
+        for dirpath, _, filenames in os.walk(source):
+            for f in filenames:
+                yield os.path.relpath(os.path.join(dirpath, f), source)
 
     @property
     def forge_version(self):
@@ -265,49 +1142,1184 @@ class CurseForgeModPack:
         return self.manifest["minecraft"]["version"]
 
 
+class CurseForgeArchiveModPack(CurseForgeModPack):
+    """
+    A modpack read directly from its zip archive.
+
+    The manifest is parsed from the archive and overrides are streamed from the archive
+    into the instance, so the modpack never has to be extracted to disk first.
+    """
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        with zipfile.ZipFile(self.archive_path) as zipf:
+            self.manifest = json.loads(zipf.read("manifest.json").decode("utf-8"))
+
+    def install_overrides(self, destination, synchronizer=None):
+        synchronizer = synchronizer if synchronizer is not None else OverrideSynchronizer()
+        return synchronizer.sync_archive(self.archive_path, self.manifest["overrides"], destination)
+
+    def override_paths(self):
+        prefix = self.manifest["overrides"].strip("/") + "/"
+        with zipfile.ZipFile(self.archive_path) as zipf:
+            for member in zipf.infolist():
+                if member.filename.startswith(prefix) and not member.is_dir():
+                    yield member.filename[len(prefix):]
+
+
+class OverrideSynchronizer:
+    """
+    Brings an instance's files up to date with a modpack's overrides.
+
+    Files that already match are skipped. A match means the same size and modification
+    time, or failing that, the same content. The remaining files are copied by a pool of
+    worker threads. Copied files get the modification time of their source, so the next
+    sync can skip them by stat alone. With link=True, files from an extracted modpack
+    are hardlinked instead of copied.
+    """
+    DEFAULT_JOBS = 8
+    COPY_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, jobs=DEFAULT_JOBS, link=False):
+        self.jobs = max(1, jobs)
+        self.link = link
+        self.logger = logger(self)
+
+    def sync_directory(self, source, destination):
+        """
+        Syncs the files under the directory source into destination. Returns the number
+        of files that were copied or linked.
+        """
+        files = list()
+        for dirpath, _, filenames in os.walk(source):
+            target_dir = os.path.join(destination, os.path.relpath(dirpath, source))
+            os.makedirs(target_dir, exist_ok=True)
+            files.extend((os.path.join(dirpath, f), os.path.join(target_dir, f)) for f in filenames)
+        return self._sync_all(self._sync_file, files)
+
+    def sync_archive(self, archive_path, prefix, destination):
+        """
+        Syncs the members of the zip archive at archive_path under the directory prefix
+        into destination. Returns the number of files that were copied.
+        """
+        prefix = prefix.strip("/") + "/"
+        destination = os.path.abspath(destination)
+        with zipfile.ZipFile(archive_path) as zipf:
+            members = list()
+            for member in zipf.infolist():
+                if not member.filename.startswith(prefix) or member.filename == prefix:
+                    continue
+                target = self._member_destination(archive_path, destination, member.filename[len(prefix):])
+                if member.is_dir():
+                    os.makedirs(target, exist_ok=True)
+                else:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    members.append((member, target))
+            return self._sync_all(lambda member, target: self._sync_member(zipf, member, target), members)
+
+    def _sync_all(self, sync_one, files):
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            copied = sum(executor.map(lambda f: sync_one(*f), files))
+        self.logger.info("%d override files were already up to date, %d updated", len(files) - copied, copied)
+        return copied
+
+    def _sync_file(self, source, target):
+        source_stat = os.stat(source)
+        target_stat = self._stat(target)
+        if target_stat is not None:
+            if self.link and os.path.samestat(source_stat, target_stat):
+                return False
+            if not self.link and target_stat.st_size == source_stat.st_size:
+                if target_stat.st_mtime_ns == source_stat.st_mtime_ns:
+                    return False
+                if filecmp.cmp(source, target, shallow=False):
+                    os.utime(target, ns=(target_stat.st_atime_ns, source_stat.st_mtime_ns))
+                    return False
+
+        # Never write through an existing file: it may be a link into the cache.
+        self._unlink(target)
+        if self.link:
+            try:
+                os.link(source, target)
+                return True
+            except OSError as e:
+                self.logger.debug("Could not hardlink %s to %s (%s), copying instead", source, target, e)
+        copy_file(source, target)
+        os.utime(target, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        return True
+
+    def _sync_member(self, zipf, member, target):
+        # Zip timestamps are local time with a two second resolution.
+        mtime = int(time.mktime(member.date_time + (0, 0, -1)))
+        target_stat = self._stat(target)
+        if target_stat is not None and target_stat.st_size == member.file_size:
+            if int(target_stat.st_mtime) == mtime:
+                return False
+            if self._crc32(target) == member.CRC:
+                os.utime(target, (target_stat.st_atime, mtime))
+                return False
+
+        self._unlink(target)
+        with zipf.open(member) as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst, self.COPY_BUFFER_SIZE)
+        os.utime(target, (mtime, mtime))
+        return True
+
+    def _member_destination(self, archive_path, destination, member_path):
+        target = os.path.abspath(os.path.join(destination, member_path))
+        if os.path.commonpath([destination, target]) != destination:
+            raise InvalidModpackError(
+                "Modpack {} contains an override outside of the instance: {}".format(archive_path, member_path)
+            )
+        return target
+
+    def _crc32(self, path):
+        crc = 0
+        with open(path, "rb", buffering=0) as f:
+            for chunk in read_chunks(f, self.COPY_BUFFER_SIZE):
+                crc = zlib.crc32(chunk, crc)
+        return crc
+
+    def _stat(self, path):
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            return None
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class InstanceLockfile:
+    """
+    Records the modpack manifest an instance was installed from and every file mccdl
+    installed for it, so that later upgrades can touch only what changed.
+    """
+    VERSION = 1
+
+    def __init__(self, manifest, files):
+        self.manifest = manifest
+        self.files = files
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the lockfile at path, or None if there is no usable lockfile.
+        """
+        try:
+            with open(path, "r") as f:
+                content = json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logging.getLogger("mccdl.InstanceLockfile").warning("Ignoring unreadable lockfile %s: %s", path, e)
+            return None
+        if content.get("version") != cls.VERSION:
+            return None
+        return cls(content["manifest"], [InstalledFile(**f) for f in content["files"]])
+
+    def save(self, path):
+        content = {
+            "version": self.VERSION,
+            "manifest": self.manifest,
+            "files": [f._asdict() for f in self.files],
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(content, indent=2, sort_keys=True))
+        os.replace(tmp_path, path)
+
+    def files_by_modpack_file(self):
+        """
+        Returns a dict mapping (project ID, file ID) as listed in the manifest to InstalledFile.
+        """
+        return dict(((f.project_id, f.file_id), f) for f in self.files)
+
+
+class HttpSession:
+    """
+    Connection-pooled HTTP session shared by every mccdl component that talks to the network.
+
+    Connections are kept alive and reused across requests to the same host, including the
+    hosts visited while following redirects. Every request gets a (connect, read) timeout
+    unless the caller provides one explicitly. The underlying requests session is only
+    created, and requests only imported, when the first request is made.
+
+    Requests that fail with a connection error, a timeout, 429 Too Many Requests or a
+    5xx status are retried up to retries times, with exponential backoff and jitter or
+    after the delay the server asks for in Retry-After. Requests go through a
+    HostRateLimiter, which is told whenever a host pushes back.
+
+    An offline session refuses to make any request, raising an OfflineError instead.
+    """
+    DEFAULT_CONNECT_TIMEOUT = 10
+    DEFAULT_READ_TIMEOUT = 60
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_RETRIES = 5
+    DEFAULT_BACKOFF = 0.5
+    MAX_BACKOFF = 60
+    MAX_RETRY_AFTER = 300
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    PUSH_BACK_STATUSES = (429, 503)
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, offline=False, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, concurrency=None, max_rate=None):
+        """
+        concurrency is the number of concurrent downloads allowed per host before any
+        push back, and defaults to pool_size. max_rate, if given, is the maximum number
+        of requests per second sent to each host.
+        """
+        self.backoff = backoff
+        self.limiter = HostRateLimiter(concurrency if concurrency is not None else pool_size, max_rate)
+        self.logger = logger(self)
+        self.offline = offline
+        # At least one attempt is always made.
+        self.retries = max(0, retries)
+        self.timeout = (connect_timeout, read_timeout)
+        self._pool_size = pool_size
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @staticmethod
+    def request_exception():
+        """
+        Returns the base class of the exceptions raised for failed requests. Only use it in
+        except clauses, which are evaluated when an exception is raised, so that requests is
+        not imported otherwise.
+        """
+        import requests
+        return requests.exceptions.RequestException
+
+    def request(self, method, url, **kwargs):
+        if self.offline:
+            raise OfflineError("Not requesting {} while offline".format(url))
+        kwargs.setdefault("timeout", self.timeout)
+        session = self._requests_session()
+        for attempt in range(self.retries + 1):
+            self.limiter.wait(url)
+            self.logger.debug("%s %s", method, url)
+            try:
+                response = session.request(method, url, **kwargs)
+            except self.request_exception() as e:
+                if attempt == self.retries or not self.is_retryable(e):
+                    raise
+                delay = self.retry_delay(attempt)
+                self.logger.warning("%s %s failed (%s), retrying in %.1f seconds", method, url, e, delay)
+            else:
+                # The limits are kept for the requested URL's host, which wait() and slot()
+                # check, even when a redirect took the request to another host such as a CDN.
+                if response.status_code not in self.RETRY_STATUSES or attempt == self.retries:
+                    self.limiter.success(url)
+                    return response
+                delay = self.retry_delay(attempt, response)
+                if response.status_code in self.PUSH_BACK_STATUSES:
+                    self.limiter.push_back(url, delay)
+                response.close()
+                self.logger.warning("%s %s returned %d, retrying in %.1f seconds",
+                                    method, url, response.status_code, delay)
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def is_retryable(self, exception):
+        """
+        Returns True if a request that failed with exception may succeed if it is retried.
+        """
+        import requests
+        return isinstance(exception, (
+            requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError
+        ))
+
+    def retry_delay(self, attempt, response=None):
+        """
+        Returns the number of seconds to wait before retrying a request for the attempt-th time,
+        counting from 0. The Retry-After header of response is honored if there is one.
+        """
+        retry_after = self._retry_after(response) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.MAX_RETRY_AFTER)
+        # Half of the delay is random so that workers that failed together don't all
+        # retry together.
+        delay = min(self.MAX_BACKOFF, self.backoff * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @classmethod
+    def _retry_after(cls, response):
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        from email.utils import parsedate_to_datetime
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+    def _requests_session(self):
+        with self._session_lock:
+            if self._session is None:
+                import requests
+                self._session = requests.Session()
+                # pool_connections is the number of distinct hosts to keep pools for;
+                # pool_maxsize is the number of connections kept alive per host.
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self._pool_size, pool_maxsize=self._pool_size
+                )
+                self._session.mount("http://", adapter)
+                self._session.mount("https://", adapter)
+            return self._session
+
+
+class HostRateLimiter:
+    """
+    Limits the requests and concurrent downloads mccdl sends to each host, and backs off
+    when a host pushes back.
+
+    Each host gets a token bucket allowing max_rate requests per second (unlimited if
+    max_rate is None) and a limit on concurrent downloads, starting at max_concurrency.
+    When a host answers 429 Too Many Requests or 503 Service Unavailable, its limit is
+    halved and nothing more is sent to it until the requested delay has passed. The
+    limit then grows back by one for every limit successful requests.
+    """
+
+    class HostState:
+        def __init__(self, limit, tokens):
+            self.in_flight = 0
+            self.limit = limit
+            self.resume_at = 0
+            self.successes = 0
+            self.tokens = tokens
+            self.updated = time.monotonic()
+
+    def __init__(self, max_concurrency, max_rate=None):
+        self.logger = logger(self)
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_rate = max_rate
+        self._cond = threading.Condition()
+        self._hosts = dict()
+
+    def wait(self, url):
+        """
+        Waits until a request may be sent to the host of url.
+        """
+        with self._cond:
+            state = self._state(url)
+            while True:
+                now = time.monotonic()
+                delay = state.resume_at - now
+                if delay <= 0 and self.max_rate is None:
+                    return
+                if delay <= 0:
+                    state.tokens = min(self._burst, state.tokens + (now - state.updated) * self.max_rate)
+                    state.updated = now
+                    if state.tokens >= 1:
+                        state.tokens -= 1
+                        return
+                    delay = (1 - state.tokens) / self.max_rate
+                self._cond.wait(delay)
+
+    @contextmanager
+    def slot(self, url):
+        """
+        Context manager that holds one of the concurrent download slots of the host of url.
+        """
+        with self._cond:
+            state = self._state(url)
+            while state.in_flight >= state.limit:
+                self._cond.wait()
+            state.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                state.in_flight -= 1
+                self._cond.notify_all()
+
+    def push_back(self, url, delay):
+        """
+        Records that the host of url asked us to slow down for delay seconds.
+        """
+        with self._cond:
+            state = self._state(url)
+            now = time.monotonic()
+            # Workers that were already waiting on the host report the same push back;
+            # only the first report lowers the limit.
+            if now >= state.resume_at:
+                state.limit = max(1, state.limit // 2)
+                self.logger.warning("%s is throttling requests, lowering concurrency to %d",
+                                    urlsplit(url).netloc, state.limit)
+            state.resume_at = max(state.resume_at, now + delay)
+            state.successes = 0
+
+    def success(self, url):
+        with self._cond:
+            state = self._state(url)
+            state.successes += 1
+            if state.successes >= state.limit and state.limit < self.max_concurrency:
+                state.limit += 1
+                state.successes = 0
+                self._cond.notify_all()
+
+    @property
+    def _burst(self):
+        return max(1.0, self.max_rate)
+
+    def _state(self, url):
+        host = urlsplit(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = self.HostState(self.max_concurrency, self._burst if self.max_rate else 0)
+        return self._hosts[host]
+
+
+class CacheIndex:
+    """
+    SQLite-backed index of the download cache.
+
+    Records, for every cached URL, the blob holding its content, the size of that blob,
+    when it was fetched and when it was last used, along with running hit/miss counters.
+    URLs that the server answered with 404 Not Found are recorded too.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS urls (
+            url TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            project_id TEXT,
+            fetched_at REAL NOT NULL,
+            last_access REAL NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            validated_at REAL NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS urls_sha256 ON urls (sha256);
+        CREATE INDEX IF NOT EXISTS urls_last_access ON urls (last_access);
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            sha256 TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS missing (
+            url TEXT PRIMARY KEY,
+            checked_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+    ENTRY_COLUMNS = (
+        "url, filename, sha256, size, project_id, fetched_at, last_access, etag, last_modified, validated_at"
+    )
+    # Columns added after the first release of the index, with their definitions.
+    MIGRATED_COLUMNS = (
+        ("etag", "TEXT"),
+        ("last_modified", "TEXT"),
+        ("validated_at", "REAL NOT NULL DEFAULT 0"),
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(self.SCHEMA)
+            self._migrate()
+
+    def _migrate(self):
+        columns = set(r[1] for r in self._db.execute("PRAGMA table_info(urls)"))
+        for name, definition in self.MIGRATED_COLUMNS:
+            if name not in columns:
+                self._db.execute("ALTER TABLE urls ADD COLUMN {} {}".format(name, definition))
+
+    def lookup(self, url):
+        """
+        Returns the CacheIndexEntry for url, or None, marking the entry as recently used.
+        """
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT {} FROM urls WHERE url = ?".format(self.ENTRY_COLUMNS), (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE urls SET last_access = ? WHERE url = ?", (time.time(), url))
+        return CacheIndexEntry(*row)
+
+    def store(self, url, filename, sha256, size, project_id=None, etag=None, last_modified=None):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO urls ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)".format(self.ENTRY_COLUMNS),
+                (url, filename, sha256, size, None if project_id is None else str(project_id), now, now,
+                 etag, last_modified, now)
+            )
+            self._db.execute("DELETE FROM missing WHERE url = ?", (url,))
+
+    def mark_missing(self, url):
+        """
+        Records that the server reported url as not found.
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO missing (url, checked_at) VALUES (?, ?)", (url, time.time()))
+
+    def is_missing(self, url, max_age=None):
+        """
+        Returns True if the server reported url as not found, within the last max_age
+        seconds if max_age is given.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT checked_at FROM missing WHERE url = ?", (url,)).fetchone()
+        return row is not None and (max_age is None or time.time() - row[0] <= max_age)
+
+    def mark_validated(self, url):
+        """
+        Records that the cached content of url was confirmed to be current.
+        """
+        with self._lock, self._db:
+            self._db.execute("UPDATE urls SET validated_at = ? WHERE url = ?", (time.time(), url))
+
+    def remove(self, url):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM urls WHERE url = ?", (url,))
+
+    def references(self, sha256):
+        """
+        Returns True if any URL in the index refers to the blob sha256.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM urls WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone()
+        return row is not None
+
+    def entries(self):
+        with self._lock:
+            rows = self._db.execute("SELECT {} FROM urls".format(self.ENTRY_COLUMNS)).fetchall()
+        return [CacheIndexEntry(*r) for r in rows]
+
+    def least_recently_used(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT {} FROM urls ORDER BY last_access ASC".format(self.ENTRY_COLUMNS)
+            ).fetchall()
+        return [CacheIndexEntry(*r) for r in rows]
+
+    def total_size(self):
+        """
+        Returns the number of bytes held by distinct blobs in the cache.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM urls)"
+            ).fetchone()
+        return row[0]
+
+    def size_by_project(self):
+        """
+        Returns a list of (project_id, entry count, bytes) tuples, largest first.
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT project_id, COUNT(*), SUM(size) FROM urls GROUP BY project_id ORDER BY SUM(size) DESC"
+            ).fetchall()
+
+    def fingerprint(self, path, size, mtime_ns):
+        """
+        Returns the recorded SHA-256 of the local file at path if its size and mtime still
+        match, otherwise None.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT sha256 FROM fingerprints WHERE path = ? AND size = ? AND mtime_ns = ?", (path, size, mtime_ns)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def store_fingerprint(self, path, size, mtime_ns, sha256):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO fingerprints (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                (path, size, mtime_ns, sha256)
+            )
+
+    def count(self, name, amount=1):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                (name, amount)
+            )
+
+    def counters(self):
+        with self._lock:
+            return dict(self._db.execute("SELECT name, value FROM counters").fetchall())
+
+
 class CachingDownloader:
-    def __init__(self, cache_dir):
+    """
+    Downloads files over HTTP, caching them in a content-addressed store.
+
+    Each downloaded file is stored once as a blob named by the SHA-256 of its content.
+    The cache index maps each URL to its blob and original filename, so any number of
+    URLs (and instances) can share a single copy of the same bytes.
+
+    If missing_ttl is given, a URL the server answered with 404 Not Found is not requested
+    again for that many seconds.
+
+    An offline downloader only serves what is already cached. Fetching anything else
+    raises an OfflineError, and cached copies of changing URLs are used without being
+    revalidated.
+    """
+    LINK_MODES = ("copy", "hardlink", "reflink", "symlink")
+    DEFAULT_LINK_MODE = "copy"
+    DEFAULT_CHUNK_SIZE = 1024 * 1024
+    HASH_CHUNK_SIZE = 1024 * 1024
+
+    # From linux/fs.h; clones the extents of one file into another on filesystems
+    # that support it (btrfs, XFS, ...).
+    FICLONE = 0x40049409
+
+    def __init__(self, cache_dir, session, link_mode=DEFAULT_LINK_MODE, chunk_size=DEFAULT_CHUNK_SIZE,
+                 tracer=None, offline=False, missing_ttl=None):
+        assert link_mode in self.LINK_MODES
         self.cache_dir = cache_dir
+        self.chunk_size = chunk_size
+        self.index = CacheIndex(os.path.join(cache_dir, "index.sqlite3"))
+        self.link_mode = link_mode
         self.logger = logger(self)
-
-    def download(self, url, destination=None):
+        self.missing_ttl = missing_ttl
+        self.offline = offline
+        self.session = session
+        self.tracer = tracer if tracer is not None else Tracer()
+        self._url_locks = dict()
+        self._url_locks_lock = threading.Lock()
+
+    def download(self, url, destination=None, project_id=None, max_age=None):
+        """
+        Downloads url, returning the path to the file. See materialize() for destination.
+        """
+        return self.materialize(self.fetch(url, project_id, max_age), destination)
+
+    def fetch(self, url, project_id=None, max_age=None):
+        """
+        Ensures that the content of url is in the cache, returning a CachedFile describing it.
+
+        project_id is recorded in the cache index so that cache statistics can be broken
+        down by project.
+
+        max_age should be given for URLs whose content may change. When the cached copy was
+        last validated more than max_age seconds ago, it is revalidated with a conditional
+        request and only downloaded again if the server reports that it changed.
+
+        Raises a DownloadNotFoundError if the server reports that url does not exist.
+        """
+        with self.tracer.phase("fetch", url=url) as event:
+            # Only one thread at a time may fetch a given URL, so that concurrent requests for
+            # the same file share a single download instead of racing on its partial file.
+            with self._url_lock(url):
+                entry = self._cached_entry(url)
+                if entry is None:
+                    self._raise_if_known_missing(url)
+                if entry is None and self.offline:
+                    raise OfflineError("{} is not in the download cache".format(url))
+                if entry is None:
+                    self.logger.debug("No cached download for %s, downloading", url)
+                    self.index.count("misses")
+                    self.tracer.count("cache_misses")
+                    event["cache"] = "miss"
+                    return self._download(url, project_id)
+
+                if max_age is not None and not self.offline and time.time() - entry.validated_at > max_age:
+                    self.logger.debug("Cached download for %s is stale, revalidating", url)
+                    self.index.count("revalidations")
+                    self.tracer.count("cache_revalidations")
+                    event["cache"] = "revalidate"
+                    return self._download(url, project_id, entry)
+
+            self.index.count("hits")
+            self.tracer.count("cache_hits")
+            event["cache"] = "hit"
+            return self._cached_file(entry)
+
+    def is_cached(self, url):
+        return self._cached_entry(url) is not None
+
+    def cached_file(self, url):
+        """
+        Returns the CachedFile for url if it is cached, otherwise None. Nothing is downloaded.
+        """
+        entry = self._cached_entry(url)
+        return self._cached_file(entry) if entry is not None else None
+
+    def blob_path(self, sha256):
+        """
+        Returns the path of the cached content with the given SHA-256, or None if it is not cached.
+        """
+        path = self._blob_path(sha256)
+        return path if os.path.exists(path) else None
+
+    def resolve(self, url):
+        """
+        Returns the filename and size (None if unknown) that downloading url would produce,
+        using a HEAD request that follows redirects.
+
+        Raises a DownloadNotFoundError if the server reports that url does not exist.
+        """
+        self._raise_if_known_missing(url)
+        response = self.session.head(url, allow_redirects=True)
+        if response.status_code == 404:
+            self.index.mark_missing(url)
+            raise DownloadNotFoundError("{} was not found".format(url))
+        response.raise_for_status()
+        return (self._download_filename(response.url), self._content_length(response))
+
+    def adopt(self, url, path, filename, sha256, project_id=None, link=False):
+        """
+        Records the local file at path, whose content has the given SHA-256, as the content
+        of url, so that fetching url becomes a cache hit. Returns False, and records nothing,
+        if the file no longer has that content.
+
+        The file is copied into the blob store, so that later changes to it cannot alter
+        the cached content. With link=True, which is only meant for files that already
+        belong to the cache, it is hardlinked instead where possible.
+        """
+        blob_path = self._blob_path(sha256)
+        if not os.path.exists(blob_path):
+            self._mkdir_p(os.path.dirname(blob_path))
+            linked = False
+            if link:
+                try:
+                    os.link(path, blob_path)
+                    linked = True
+                except FileExistsError:
+                    linked = True
+                except OSError:
+                    pass
+            if not linked:
+                tmp_path = "{}.{}.tmp".format(blob_path, threading.get_ident())
+                copy_file(path, tmp_path)
+                # path may have changed since it was hashed; the blob must match its name.
+                if sha256_file(tmp_path, self.HASH_CHUNK_SIZE) != sha256:
+                    self.logger.warning("Not adopting %s, it changed while it was being copied", path)
+                    self._unlink(tmp_path)
+                    return False
+                os.replace(tmp_path, blob_path)
+        self.logger.debug("Adopted %s as the content of %s", path, url)
+        self.index.store(url, filename, sha256, os.path.getsize(blob_path), project_id)
+        self.index.count("adopted")
+        return True
+
+    def fingerprint(self, path):
+        """
+        Returns the SHA-256 of the local file at path. Results are remembered in the cache
+        index by (path, size, mtime), so unchanged files are only hashed once.
+        """
+        st = os.stat(path)
+        path = os.path.abspath(path)
+        sha256 = self.index.fingerprint(path, st.st_size, st.st_mtime_ns)
+        if sha256 is None:
+            sha256 = sha256_file(path, self.HASH_CHUNK_SIZE)
+            self.index.store_fingerprint(path, st.st_size, st.st_mtime_ns, sha256)
+        return sha256
+
+    def enforce_size_limit(self, max_size):
+        """
+        Evicts least recently used downloads until the blobs that only the cache holds take
+        up at most max_size bytes.
+
+        A blob that is still hardlinked from outside the cache, into an instance for
+        example, would keep its bytes on disk if it were evicted. Such blobs are neither
+        counted nor evicted.
+        """
+        entries_by_blob = OrderedDict()
+        for entry in self.index.least_recently_used():
+            # A blob is as recently used as the most recently used URL that refers to it.
+            entries = entries_by_blob.pop(entry.sha256, list())
+            entries.append(entry)
+            entries_by_blob[entry.sha256] = entries
+
+        evictable = [
+            (sha256, entries) for sha256, entries in entries_by_blob.items()
+            if self._links_outside_cache(sha256, [e.url for e in entries]) == 0
+        ]
+        total_size = sum(entries[0].size for _, entries in evictable)
+        for sha256, entries in evictable:
+            if total_size <= max_size:
+                break
+            for entry in entries:
+                self.logger.debug("Evicting %s from the cache", entry.url)
+                self.index.remove(entry.url)
+                self.index.count("evictions")
+                shutil.rmtree(self._path_for_url(entry.url), ignore_errors=True)
+            self._unlink(self._blob_path(sha256))
+            total_size -= entries[0].size
+
+    def _links_outside_cache(self, sha256, urls):
+        """
+        Returns the number of hardlinks to the blob sha256 other than the blob itself and
+        the named copies kept for urls inside the cache.
+        """
+        try:
+            blob_stat = os.stat(self._blob_path(sha256))
+        except FileNotFoundError:
+            return 0
+        links = blob_stat.st_nlink - 1
+        for url in urls:
+            try:
+                dir_entries = list(os.scandir(self._path_for_url(url)))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            links -= len([e for e in dir_entries if os.path.samestat(e.stat(follow_symlinks=False), blob_stat)])
+        return links
+
+    def collect_garbage(self, max_size=None):
+        """
+        Removes index entries whose blobs are gone, blobs that no entry refers to and
+        partial downloads. Then, if max_size is given, enforces the size limit.
+        """
+        for entry in self.index.entries():
+            if not os.path.exists(self._blob_path(entry.sha256)):
+                self.logger.debug("Removing dangling cache entry for %s", entry.url)
+                self.index.remove(entry.url)
+        referenced_blobs = set(e.sha256 for e in self.index.entries())
+        for dirpath, _, filenames in os.walk(os.path.join(self.cache_dir, "blobs")):
+            for filename in filenames:
+                if filename not in referenced_blobs:
+                    self.logger.debug("Removing unreferenced blob %s", filename)
+                    self._unlink(os.path.join(dirpath, filename))
+        shutil.rmtree(os.path.join(self.cache_dir, "partial"), ignore_errors=True)
+        if max_size is not None:
+            self.enforce_size_limit(max_size)
+
+    def materialize(self, cached_file, destination=None):
+        """
+        Places the cached file at destination (or inside it, if destination is an existing
+        directory) using the configured link mode, falling back to a plain copy when the
+        link mode is not supported. Returns the path of the placed file.
+
+        If destination is None, returns a path inside the cache that carries the file's
+        original name instead.
+        """
+        if destination is None:
+            return self._named_path(cached_file)
+        with self.tracer.phase("materialize", file=cached_file.filename):
+            return self._materialize(cached_file, destination)
+
+    def _materialize(self, cached_file, destination):
+        if os.path.isdir(destination):
+            destination = os.path.join(destination, cached_file.filename)
+        self._mkdir_p(os.path.dirname(destination))
+        self.logger.debug("Materializing %s at %s (%s)", cached_file.path, destination, self.link_mode)
+
+        # Never write through an existing file: it may be a link to a blob.
+        self._unlink(destination)
+        try:
+            if self.link_mode == "hardlink":
+                os.link(cached_file.path, destination)
+            elif self.link_mode == "symlink":
+                os.symlink(os.path.abspath(cached_file.path), destination)
+            elif self.link_mode == "reflink":
+                self._reflink(cached_file.path, destination)
+            else:
+                copy_file(cached_file.path, destination)
+        except OSError as e:
+            if self.link_mode == "copy":
+                raise e
+            self.logger.debug("Could not %s %s to %s (%s), copying instead",
+                              self.link_mode, cached_file.path, destination, e)
+            self._unlink(destination)
+            copy_file(cached_file.path, destination)
+
+        return destination
+
+    def _raise_if_known_missing(self, url):
+        if not self.offline and self.missing_ttl is None:
+            return
+        if self.index.is_missing(url, None if self.offline else self.missing_ttl):
+            raise DownloadNotFoundError("{} was not found when it was last fetched".format(url))
+
+    def _url_lock(self, url):
+        with self._url_locks_lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    def _cached_entry(self, url):
+        entry = self.index.lookup(url)
+        if entry is None:
+            return self._import_legacy_download(url)
+        if not os.path.exists(self._blob_path(entry.sha256)):
+            self.logger.debug("Blob %s for %s is missing", entry.sha256, url)
+            return None
+        return entry
+
+    def _cached_file(self, entry):
+        return CachedFile(entry.url, entry.filename, entry.sha256, entry.size, self._blob_path(entry.sha256))
+
+    def _import_legacy_download(self, url):
+        # Caches written by older versions of mccdl keep a single file in a
+        # per-URL directory. Move those files into the blob store.
         url_cache_path = self._path_for_url(url)
-        self.logger.debug("Cache directory for %s is %s", url, url_cache_path)
-        cached_file_path = None
-        if os.path.exists(url_cache_path):
-            self.logger.debug("Cache directory for %s already exists", url)
+        try:
             cached_dir_content = os.listdir(url_cache_path)
-            cached_file_path = (os.path.join(url_cache_path, cached_dir_content[0])) if cached_dir_content else None
-
-        if cached_file_path is None:
-            self.logger.debug("No cached download for %s, downloading", url)
-            cached_file_path = self._download(url)
-
-        if destination is not None:
-            self.logger.debug("Copying cached file %s to %s", cached_file_path, destination)
-            destination = destination
-            self._mkdir_p(os.path.dirname(destination))
-            shutil.copy(cached_file_path, destination)
-            download_destination = destination
+        except FileNotFoundError:
+            return None
+        if not cached_dir_content:
+            return None
+        self.logger.debug("Importing legacy cached download for %s", url)
+        legacy_path = os.path.join(url_cache_path, cached_dir_content[0])
+        sha256 = sha256_file(legacy_path, self.HASH_CHUNK_SIZE)
+        self.adopt(url, legacy_path, cached_dir_content[0], sha256, link=True)
+        return self.index.lookup(url)
+
+    def _download(self, url, project_id=None, cached_entry=None):
+        with self.tracer.phase("download", url=url) as event, self._partial_lock(url):
+            if cached_entry is None:
+                # Another process sharing the cache may have downloaded url while we waited.
+                entry = self._cached_entry(url)
+                if entry is not None:
+                    return self._cached_file(entry)
+
+            with self.session.limiter.slot(url):
+                # HttpSession retries failed requests; this only retries downloads that fail
+                # partway through the body, resuming from the bytes received so far.
+                for attempt in range(self.session.retries + 1):
+                    try:
+                        cached_file = self._download_to_cache(url, project_id, cached_entry)
+                        break
+                    except IncompleteDownloadError as e:
+                        if attempt == self.session.retries:
+                            raise
+                        delay = self.session.retry_delay(attempt)
+                        self.logger.warning("Download of %s failed (%s), retrying in %.1f seconds", url, e, delay)
+                        self.index.count("retries")
+                        self.tracer.count("download_retries")
+                        time.sleep(delay)
+            event["bytes"] = cached_file.size
+            return cached_file
+
+    @contextmanager
+    def _partial_lock(self, url):
+        """
+        Holds an exclusive lock on the partial download of url, so that mccdl processes
+        sharing the cache never write the same partial file at once. _url_lock() does the
+        same for the threads of one process.
+        """
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        lock_path = self._partial_path(url) + ".lock"
+        self._mkdir_p(os.path.dirname(lock_path))
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # The previous holder removes the lock file when it is done; if it did, lock
+            # the file that replaced it instead.
+            try:
+                if os.path.samestat(os.fstat(fd), os.stat(lock_path)):
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+        try:
+            yield
+        finally:
+            self._unlink(lock_path)
+            os.close(fd)
+
+    def _download_to_cache(self, url, project_id=None, cached_entry=None):
+        headers = dict()
+        resume_from = 0
+        if cached_entry is not None:
+            if cached_entry.etag is not None:
+                headers["If-None-Match"] = cached_entry.etag
+            if cached_entry.last_modified is not None:
+                headers["If-Modified-Since"] = cached_entry.last_modified
         else:
-            download_destination = cached_file_path
-
-        return download_destination
-
-    def _download(self, url):
-        url_cache_path = self._path_for_url(url)
-
-        response = requests.get(url, stream=True)
+            resume_from = self._resume_headers(url, headers)
+
+        response = self.session.get(url, stream=True, headers=headers)
+        if response.status_code == 304 and cached_entry is not None:
+            self.logger.debug("Cached download for %s is still current", url)
+            response.close()
+            self.index.mark_validated(url)
+            return self._cached_file(cached_entry)
+        if response.status_code == 416 and resume_from:
+            self.logger.debug("Server refused to resume %s, starting over", url)
+            response.close()
+            self._discard_partial(url)
+            return self._download_to_cache(url, project_id)
+        if response.status_code == 404:
+            response.close()
+            self.index.mark_missing(url)
+            raise DownloadNotFoundError("{} was not found".format(url))
         response.raise_for_status()
-        download_destination = self._download_destination(url_cache_path, response.url)
+        filename = self._download_filename(response.url)
+
+        partial_path = self._partial_path(url)
+        digest = hashlib.sha256()
+        offset, expected_size = self._parse_content_range(response)
+        if response.status_code == 206 and offset == resume_from:
+            self.logger.debug("Resuming download of %s at byte %d", url, offset)
+            sha256_file(partial_path, self.HASH_CHUNK_SIZE, digest)
+            mode = "r+b"
+        else:
+            if response.status_code == 206:
+                # Not the range we asked for; fetch the whole file instead.
+                response.close()
+                self._discard_partial(url)
+                return self._download_to_cache(url, project_id)
+            offset, expected_size = 0, self._content_length(response)
+            mode = "wb"
+            self._save_partial_validators(url, response)
+
+        size = offset
+        with open(partial_path, mode) as f:
+            f.seek(offset)
+            if expected_size is not None:
+                self._preallocate(f, expected_size)
+            try:
+                for buf in response.iter_content(self.chunk_size):
+                    f.write(buf)
+                    digest.update(buf)
+                    size += len(buf)
+            except HttpSession.request_exception() as e:
+                if not self.session.is_retryable(e):
+                    raise
+                raise IncompleteDownloadError(
+                    "Download of {} was interrupted after {} bytes: {}".format(url, size, e)
+                ) from e
+            finally:
+                # Give back preallocated space that was never written, so that the size of
+                # the partial file is the offset to resume from.
+                f.truncate(size)
+
+        if expected_size is not None and size != expected_size:
+            if size > expected_size:
+                self._discard_partial(url)
+            raise IncompleteDownloadError(
+                "Download of {} ended after {} of {} bytes".format(url, size, expected_size)
+            )
 
-        self._mkdir_p(os.path.dirname(download_destination))
+        sha256 = digest.hexdigest()
+        blob_path = self._blob_path(sha256)
+        self._mkdir_p(os.path.dirname(blob_path))
+        os.replace(partial_path, blob_path)
+        self._discard_partial(url)
+        self.index.count("bytes_downloaded", size - offset)
+        self.tracer.count("bytes_downloaded", size - offset)
+
+        self.index.store(url, filename, sha256, size, project_id,
+                         etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"))
+        return CachedFile(url, filename, sha256, size, blob_path)
+
+    def _preallocate(self, f, size):
+        # Reserving the whole file up front lets the filesystem lay it out contiguously,
+        # and makes a full disk fail the download right away rather than partway through.
+        # If mccdl is killed before truncating, the partial file is left at its full size;
+        # resuming it then asks for a range past the end, and the 416 restarts the download.
+        if not hasattr(os, "posix_fallocate"):
+            return
+        f.flush()
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                raise
+            self.logger.debug("Could not preallocate %d bytes for %s: %s", size, f.name, e)
+
+    def _resume_headers(self, url, headers):
+        """
+        Adds Range and If-Range headers to headers if a partial download of url can be
+        resumed. Returns the offset to resume from, or 0 if the download starts over.
+        """
+        partial_path = self._partial_path(url)
+        try:
+            offset = os.path.getsize(partial_path)
+            with open(partial_path + ".json", "r") as f:
+                validators = json.loads(f.read())
+        except (OSError, ValueError):
+            self._discard_partial(url)
+            return 0
+
+        # If-Range needs a strong validator; without one we cannot know that the
+        # bytes we already have belong to the file the server would send now.
+        etag = validators.get("etag")
+        validator = etag if etag and not etag.startswith("W/") else validators.get("last_modified")
+        if not offset or not validator:
+            self._discard_partial(url)
+            return 0
+        headers["Range"] = "bytes={}-".format(offset)
+        headers["If-Range"] = validator
+        return offset
+
+    def _save_partial_validators(self, url, response):
+        partial_path = self._partial_path(url)
+        self._mkdir_p(os.path.dirname(partial_path))
+        validators = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+        with open(partial_path + ".json", "w") as f:
+            f.write(json.dumps(validators))
+
+    def _discard_partial(self, url):
+        partial_path = self._partial_path(url)
+        self._unlink(partial_path)
+        self._unlink(partial_path + ".json")
 
-        with open(download_destination, "wb") as f:
-            for buf in response.iter_content(1024):
-                f.write(buf)
+    @classmethod
+    def _content_length(cls, response):
+        # With a Content-Encoding, Content-Length counts the encoded bytes rather than
+        # the decoded bytes we write to disk.
+        if response.headers.get("Content-Encoding", "identity") != "identity":
+            return None
+        content_length = response.headers.get("Content-Length")
+        return int(content_length) if content_length is not None and content_length.isdigit() else None
 
-        return download_destination
+    @classmethod
+    def _parse_content_range(cls, response):
+        """
+        Returns the (offset, total size) of a 206 response. total size is None if unknown.
+        """
+        match = re.match(r"^bytes ([0-9]+)-[0-9]+/([0-9]+|\*)$", response.headers.get("Content-Range", ""))
+        if response.status_code != 206 or match is None:
+            return (None, None)
+        total = match.group(2)
+        return (int(match.group(1)), int(total) if total != "*" else None)
+
+    def _named_path(self, cached_file):
+        """
+        Returns a path inside the cache with the file's original name, linked to its blob.
+        """
+        named_path = self._download_destination(self._path_for_url(cached_file.url), cached_file.filename)
+        if not os.path.exists(named_path):
+            self._mkdir_p(os.path.dirname(named_path))
+            try:
+                os.link(cached_file.path, named_path)
+            except FileExistsError:
+                pass
+            except OSError:
+                copy_file(cached_file.path, named_path)
+        return named_path
+
+    def _reflink(self, source, destination):
+        import fcntl
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
 
     def _mkdir_p(self, path):
         try:
@@ -316,51 +2328,386 @@ class CachingDownloader:
             if not e.errno == errno.EEXIST:
                 raise e
 
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
     def _url_digest(self, url):
         return hashlib.sha256(url.encode("utf-8")).hexdigest()
 
     def _path_for_url(self, url):
         return os.path.join(self.cache_dir, self._url_digest(url))
 
+    def _partial_path(self, url):
+        return os.path.join(self.cache_dir, "partial", self._url_digest(url))
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.cache_dir, "blobs", sha256[:2], sha256)
+
     @classmethod
     def _download_filename(cls, response_url):
         return urlunquote(response_url.split("/")[-1])
 
-    def _download_destination(self, dir_path, url):
-        return os.path.join(dir_path, self._download_filename(url))
+    def _download_destination(self, dir_path, filename):
+        return os.path.join(dir_path, filename)
+
+
+class MirrorServer:
+    """
+    Serves the download cache of a CurseForgeClient over HTTP as a mirror of CurseForge
+    and the MultiMC Forge metadata site, for other copies of mccdl to use as their
+    --curse-base-url and --forge-meta-url.
+
+    Requests use the same paths as upstream. Anything that is not cached yet is fetched
+    from upstream first; concurrent requests for the same file wait for a single fetch.
+    File downloads are answered with a redirect to /blobs/<sha256>/<filename>, which
+    never changes, so clients see the upstream file name and can resume downloads and
+    revalidate their cached copies cheaply.
+
+    Project pages link to their icons on the upstream site; icons are not mirrored.
+    """
+    DEFAULT_PORT = 8080
+    DEFAULT_MISSING_TTL = 6 * 60 * 60
+    FORGE_META_PATH = "/net.minecraftforge/"
+
+    def __init__(self, client, host="", port=DEFAULT_PORT):
+        from http.server import ThreadingHTTPServer
+        self.client = client
+        self.logger = logger(self)
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+
+    @property
+    def server_address(self):
+        return self._httpd.server_address
+
+    def serve_forever(self):
+        self.logger.info("Serving the mccdl cache on %s:%d", *self.server_address[:2])
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+    def shutdown(self):
+        self._httpd.shutdown()
+
+    def _make_handler(self):
+        from http.server import BaseHTTPRequestHandler
+        mirror = self
+        client = self.client
+        downloader = client.downloader
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            routes = (
+                (r"^/projects/([^/]+)/files/(latest)$", "redirect_to_blob"),
+                (r"^/projects/([^/]+)/files/([0-9]+)/download$", "redirect_to_blob"),
+                (r"^/projects/([^/]+)/files/?$", "send_listing"),
+                (r"^/projects/([^/]+)/?$", "send_project_page"),
+                (r"^{}([^/]+)\.json$".format(re.escape(mirror.FORGE_META_PATH)), "send_forge_patch"),
+                (r"^/blobs/([0-9a-f]{64})/([^/]+)$", "send_blob"),
+            )
+
+            def log_message(self, format, *args):
+                mirror.logger.debug("%s %s", self.address_string(), format % args)
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                for regex, handler_name in self.routes:
+                    match = re.match(regex, path)
+                    if match is None:
+                        continue
+                    try:
+                        return getattr(self, handler_name)(*match.groups())
+                    except DownloadNotFoundError:
+                        return self.send_bytes(b"Not found upstream", status=404)
+                    except ConnectionError:
+                        # The client went away; there is nobody left to tell.
+                        raise
+                    except Exception as e:
+                        mirror.logger.error("Failed to serve %s: %s", path, e)
+                        return self.send_bytes(str(e).encode("utf-8"), status=502)
+                self.send_bytes(b"Not found", status=404)
+
+            def redirect_to_blob(self, project_id, file_id):
+                project = client.project(project_id)
+                max_age = client.mutable_ttl if file_id == "latest" else None
+                cached_file = downloader.fetch(project.file_url(file_id), project_id, max_age)
+                self.send_response(302)
+                self.send_header(
+                    "Location", "/blobs/{}/{}".format(cached_file.sha256, urlquote(cached_file.filename))
+                )
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def send_listing(self, project_id):
+                url = client.project(project_id).url_for("files")
+                self.send_cached_file(downloader.fetch(url, project_id, client.file_listings.ttl), "text/html")
+
+            def send_project_page(self, project_id):
+                url = client.project(project_id).url_for()
+                self.send_cached_file(downloader.fetch(url, project_id, client.mutable_ttl), "text/html")
+
+            def send_forge_patch(self, forge_version):
+                url = MultiMcInstance.forge_config_url(forge_version, client.forge_meta_url)
+                self.send_cached_file(downloader.fetch(url), "application/json")
+
+            def send_blob(self, sha256, filename):
+                blob_path = downloader.blob_path(sha256)
+                if blob_path is None:
+                    return self.send_bytes(b"Not found", status=404)
+                etag = '"{}"'.format(sha256)
+                if self.headers.get("If-None-Match") == etag:
+                    return self.send_bytes(b"", status=304, headers=(("ETag", etag),))
+
+                size = os.path.getsize(blob_path)
+                offset = 0
+                headers = [("ETag", etag), ("Accept-Ranges", "bytes")]
+                match = re.match(r"^bytes=([0-9]+)-$", self.headers.get("Range", ""))
+                if match is not None and self.headers.get("If-Range") in (None, etag):
+                    offset = int(match.group(1))
+                    if offset >= size:
+                        return self.send_bytes(b"", status=416, headers=(("Content-Range", "bytes */{}".format(size)),))
+                    headers.append(("Content-Range", "bytes {}-{}/{}".format(offset, size - 1, size)))
+                self.send_file(blob_path, offset, size, status=206 if offset else 200, headers=headers)
+
+            def send_cached_file(self, cached_file, content_type):
+                self.send_file(cached_file.path, 0, cached_file.size, content_type=content_type)
+
+            def send_file(self, path, offset, size, status=200, content_type="application/octet-stream",
+                          headers=()):
+                with open(path, "rb") as f:
+                    self.send_response(status)
+                    self.send_header("Content-Type", content_type)
+                    for k, v in headers:
+                        self.send_header(k, v)
+                    self.send_header("Content-Length", str(size - offset))
+                    self.end_headers()
+                    if self.command == "HEAD":
+                        return
+                    # socket.sendfile() uses os.sendfile() where available, so file contents
+                    # go straight from the page cache to the socket.
+                    self.wfile.flush()
+                    self.connection.sendfile(f, offset, size - offset)
+
+            def send_bytes(self, body, status=200, headers=()):
+                self.send_response(status)
+                for k, v in headers:
+                    self.send_header(k, v)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+        return Handler
 
 
 class MccdlCommandLineApplication:
     def __init__(self):
-        self.argparser = argparse.ArgumentParser()
+        self.argparser = argparse.ArgumentParser(
+            epilog="Run '%(prog)s cache --help' to inspect or clean up the download cache, or "
+                   "'%(prog)s prefetch --help' to download modpacks without installing them, or "
+                   "'%(prog)s serve --help' to share your cache with other machines."
+        )
         self.configure_argparser()
+        self.cache_argparser = argparse.ArgumentParser(prog="mccdl cache")
+        self.configure_cache_argparser()
+        self.prefetch_argparser = argparse.ArgumentParser(
+            prog="mccdl prefetch",
+            description="Download everything needed to install the given modpacks into the cache, "
+                        "so that they can later be installed with --offline."
+        )
+        self.configure_prefetch_argparser()
+        self.serve_argparser = argparse.ArgumentParser(
+            prog="mccdl serve",
+            description="Serve the download cache over HTTP as a mirror of CurseForge and the MultiMC "
+                        "Forge metadata site. Point other copies of mccdl at it with --curse-base-url "
+                        "http://HOST:PORT and --forge-meta-url http://HOST:PORT/net.minecraftforge."
+        )
+        self.configure_serve_argparser()
         self.logger = logger(self)
 
-    def configure_argparser(self):
-        a = self.argparser
+    def configure_common_arguments(self, a):
         a.add_argument(
-            "-c", "--cache-directory", type=str, default=str(CurseForgeClient.DEFAULT_CACHE_DIR),
-            help="Path to directory to cache mccdl files. Defaults to %(default)s."
+            "-c", "--cache-directory", type=str, default=None,
+            help="Path to directory to cache mccdl files. Defaults to the user cache directory, "
+                 "e.g. ~/.cache/mccdl on Linux."
         )
         a.add_argument(
             "-l", "--log-level", type=str, default="info",
             choices=("debug", "info", "warning", "error", "critical"),
             help="Log level to use  for this run. Defaults to %(default)s."
         )
+        a.add_argument(
+            "--cache-max-size", type=parse_size, default=None,
+            help="Evict least recently used downloads once the cache grows beyond this size, "
+                 "e.g. 500M or 20G. Unbounded by default."
+        )
+
+    def configure_download_arguments(self, a):
+        a.add_argument(
+            "-j", "--jobs", type=int, default=CurseForgeClient.DEFAULT_JOBS,
+            help="Number of modpack files to download concurrently. Defaults to %(default)s."
+        )
+        a.add_argument(
+            "--link-overrides", action="store_true", default=False,
+            help="Hardlink modpack override files into instances from an extracted copy of the "
+                 "modpack in the cache instead of copying them. Only use this if nothing edits "
+                 "those files in place, since edits would also change the cached copy."
+        )
+        a.add_argument(
+            "--chunk-size", type=parse_size, default=CachingDownloader.DEFAULT_CHUNK_SIZE,
+            help="Size of the buffer used to stream downloads to disk, e.g. 256K or 4M. "
+                 "Defaults to %(default)s bytes."
+        )
+        a.add_argument(
+            "--mutable-ttl", type=float, default=CurseForgeClient.DEFAULT_MUTABLE_TTL,
+            help="Seconds a cached download of a changing URL, such as the latest file of a "
+                 "modpack, is used before checking for a newer version. Defaults to %(default)s."
+        )
+        a.add_argument(
+            "--listing-ttl", type=float, default=CurseForgeFileListingCache.DEFAULT_TTL,
+            help="Seconds to reuse a project's cached file listing when looking for a replacement "
+                 "for a missing file. Defaults to %(default)s."
+        )
+        a.add_argument(
+            "--connect-timeout", type=float, default=HttpSession.DEFAULT_CONNECT_TIMEOUT,
+            help="Seconds to wait for an HTTP connection to be established. Defaults to %(default)s."
+        )
+        a.add_argument(
+            "--read-timeout", type=float, default=HttpSession.DEFAULT_READ_TIMEOUT,
+            help="Seconds to wait for an HTTP server to send data. Defaults to %(default)s."
+        )
+        a.add_argument(
+            "--retries", type=parse_count, default=HttpSession.DEFAULT_RETRIES,
+            help="Number of times to retry a request or download that fails with a connection error, "
+                 "a timeout, 429 or 5xx. Defaults to %(default)s."
+        )
+        a.add_argument(
+            "--max-rate", type=float, default=None,
+            help="Maximum number of requests per second to send to each host. Unlimited by default; "
+                 "concurrency is lowered automatically when a host throttles mccdl either way."
+        )
+        a.add_argument(
+            "--curse-base-url", type=str, default=None,
+            help="Base URL to use instead of {}, such as an 'mccdl serve' mirror.".format(
+                CurseForgeClient.CURSE_BASE_URL
+            )
+        )
+        a.add_argument(
+            "--forge-meta-url", type=str, default=None,
+            help="URL to use instead of {}, such as an 'mccdl serve' mirror's /net.minecraftforge.".format(
+                MultiMcInstance.MULTIMC_FORGE_CONFIGURATION_SITE
+            )
+        )
+
+    def configure_prefetch_argparser(self):
+        a = self.prefetch_argparser
+        self.configure_common_arguments(a)
+        self.configure_download_arguments(a)
+        a.add_argument(
+            "modpack_urls", type=str, nargs="+", metavar="modpack_url",
+            help="Link to a modpack on Minecraft CurseForge."
+        )
+        a.set_defaults(multimc_directory=None, reconcile="none", offline=False)
+
+    def configure_serve_argparser(self):
+        a = self.serve_argparser
+        self.configure_common_arguments(a)
+        self.configure_download_arguments(a)
+        a.add_argument(
+            "--bind", type=str, default="",
+            help="Address to listen on. Defaults to all addresses."
+        )
+        a.add_argument(
+            "--port", type=int, default=MirrorServer.DEFAULT_PORT,
+            help="Port to listen on. Defaults to %(default)s."
+        )
+        a.add_argument(
+            "--missing-ttl", type=float, default=MirrorServer.DEFAULT_MISSING_TTL,
+            help="Seconds to remember that a file was not found upstream before asking again. "
+                 "Defaults to %(default)s."
+        )
+        a.set_defaults(multimc_directory=None, reconcile="none", offline=False)
+
+    def configure_cache_argparser(self):
+        a = self.cache_argparser
+        self.configure_common_arguments(a)
+        a.add_argument(
+            "cache_command", type=str, choices=("gc", "stats"),
+            help="gc removes stale and unreferenced cache files and enforces --cache-max-size; "
+                 "stats prints cache usage and hit rates."
+        )
+
+    def configure_argparser(self):
+        a = self.argparser
+        self.configure_common_arguments(a)
+        self.configure_download_arguments(a)
         a.add_argument(
             "--upgrade", action="store_true", default=False,
             help="If specified, allow upgrading an existing modpack instance."
         )
         a.add_argument(
-            "--multimc-directory", type=str, default=appdirs.user_data_dir("multimc"),
-            help="Path to the MultiMC directory. Defaults to %(default)s."
+            "--multimc-directory", type=str, default=None,
+            help="Path to the MultiMC directory. Defaults to the user data directory for MultiMC, "
+                 "e.g. ~/.local/share/multimc on Linux."
+        )
+        a.add_argument(
+            "--link-mode", type=str, default=CachingDownloader.DEFAULT_LINK_MODE,
+            choices=CachingDownloader.LINK_MODES,
+            help="How to place cached files into instances. hardlink, reflink and symlink avoid "
+                 "duplicating bytes and fall back to copy where unsupported. Defaults to %(default)s."
+        )
+        a.add_argument(
+            "--reconcile", type=str, default="instance", choices=ModsDirectoryReconciler.SCOPES,
+            help="Before downloading, look for jars that are already on disk and use them instead: "
+                 "in the target instance only, in all MultiMC instances, or not at all. "
+                 "Defaults to %(default)s."
         )
         a.add_argument(
-            "modpack_url", type=str,
+            "--offline", action="store_true", default=False,
+            help="Never use the network. Everything needed must already be in the cache, "
+                 "for example from '%(prog)s prefetch'; anything missing is an error."
+        )
+        a.add_argument(
+            "--resolve-sizes", action="store_true", default=False,
+            help="Look up the size of every file to be downloaded before starting, and download the "
+                 "largest first. Costs an extra request per file; worth it for packs with a few "
+                 "very large files on a slow link."
+        )
+        a.add_argument(
+            "--dry-run", action="store_true", default=False,
+            help="Work out which files would be downloaded and how big they are, print that and "
+                 "exit without changing any instance. Only the modpack itself is downloaded."
+        )
+        a.add_argument(
+            "--trace", type=str, default=None, metavar="FILE",
+            help="Write per-phase timings, byte counts, cache hit/miss counts and per-file "
+                 "latencies for this run to FILE as JSON."
+        )
+        a.add_argument(
+            "--profile", type=str, default=None, metavar="FILE",
+            help="Profile this run, including worker threads, and write the results to FILE "
+                 "in pstats format."
+        )
+        a.add_argument(
+            "--batch", type=str, default=None, metavar="SPEC_FILE",
+            help="Install or upgrade many instances at once, as listed in a JSON file containing "
+                 'a list of {"url": ..., "instance": ..., "mode": "install" or "upgrade"} objects. '
+                 "Files shared between instances are downloaded only once."
+        )
+        a.add_argument(
+            "modpack_url", type=str, nargs="?",
             help="Link to the modpack on Minecraft CurseForge."
         )
         a.add_argument(
-            "instance_name", type=str,
+            "instance_name", type=str, nargs="?",
             help="Name of the MultiMC instance to create."
         )
 
@@ -369,29 +2716,259 @@ class MccdlCommandLineApplication:
         logger = logging.getLogger("mccdl")
         logger.setLevel(getattr(logging, log_level.upper()))
 
-    def make_curseforge_client(self, args):
+    def make_downloader(self, args, session=None, tracer=None):
+        return CachingDownloader(
+            os.path.join(args.cache_directory, "download"), session,
+            link_mode=getattr(args, "link_mode", CachingDownloader.DEFAULT_LINK_MODE),
+            chunk_size=getattr(args, "chunk_size", CachingDownloader.DEFAULT_CHUNK_SIZE),
+            tracer=tracer, offline=getattr(args, "offline", False), missing_ttl=getattr(args, "missing_ttl", None)
+        )
+
+    def make_curseforge_client(self, args, tracer=None):
         cache_dir = args.cache_directory
-        downloader = CachingDownloader(os.path.join(cache_dir, "download"))
-        unpacker = CurseForgeDownloadUnpacker(os.path.join(cache_dir, "unpack"))
-        instance_manager = MultiMcInstanceManager(args.multimc_directory, downloader)
+        tracer = tracer if tracer is not None else Tracer()
+        session = HttpSession(
+            pool_size=max(args.jobs, HttpSession.DEFAULT_POOL_SIZE),
+            connect_timeout=args.connect_timeout, read_timeout=args.read_timeout, offline=args.offline,
+            retries=args.retries, concurrency=args.jobs, max_rate=args.max_rate
+        )
+        downloader = self.make_downloader(args, session, tracer)
+        unpacker = CurseForgeDownloadUnpacker(os.path.join(cache_dir, "unpack"), tracer=tracer)
+        instance_manager = None
+        if args.multimc_directory is not None:
+            instance_manager = MultiMcInstanceManager(
+                args.multimc_directory, downloader, tracer=tracer, forge_meta_url=args.forge_meta_url
+            )
+
+        # Offline, a cached listing is the only listing there is, however old it is.
+        listing_ttl = float("inf") if args.offline else args.listing_ttl
+        file_listings = CurseForgeFileListingCache(os.path.join(cache_dir, "listings"), ttl=listing_ttl)
+        override_sync = OverrideSynchronizer(link=args.link_overrides)
 
-        return CurseForgeClient(instance_manager, downloader, unpacker)
+        return CurseForgeClient(
+            instance_manager, downloader, unpacker, session, jobs=args.jobs, mutable_ttl=args.mutable_ttl,
+            file_listings=file_listings, tracer=tracer, override_sync=override_sync, reconcile=args.reconcile,
+            curse_base_url=args.curse_base_url, forge_meta_url=args.forge_meta_url,
+            resolve_sizes=getattr(args, "resolve_sizes", False)
+        )
 
     def run(self, argv):
-        args = self.argparser.parse_args(argv)
+        if argv[:1] == ["cache"]:
+            return self.run_cache_command(argv[1:])
+        if argv[:1] == ["prefetch"]:
+            return self.run_prefetch_command(argv[1:])
+        if argv[:1] == ["serve"]:
+            return self.run_serve_command(argv[1:])
+
+        args = self.parse_args(self.argparser, argv)
+        if args.cache_max_size is not None and args.link_mode == "symlink":
+            self.argparser.error("--cache-max-size cannot be used with --link-mode=symlink: evicting a "
+                                 "download would leave dangling symlinks in the instances that use it")
+        if args.multimc_directory is None:
+            import appdirs
+            args.multimc_directory = appdirs.user_data_dir("multimc")
+        if args.batch is None and (args.modpack_url is None or args.instance_name is None):
+            self.argparser.error("modpack_url and instance_name are required unless --batch is given")
+        self.configure_logging(args.log_level)
+        if args.profile is None:
+            return self.run_modpacks(args)
+        profiler = ThreadProfiler()
+        try:
+            return profiler.runcall(self.run_modpacks, args)
+        finally:
+            profiler.dump_stats(args.profile)
+            self.logger.info("Wrote profile to %s", args.profile)
+
+    def parse_args(self, parser, argv):
+        args = parser.parse_args(argv)
+        # Resolved after parsing rather than as argparse defaults, so that --help and runs
+        # which pass the directory explicitly don't need to import appdirs.
+        if args.cache_directory is None:
+            args.cache_directory = CurseForgeClient.default_cache_dir()
+        return args
+
+    def run_modpacks(self, args):
+        tracer = Tracer()
+        c = self.make_curseforge_client(args, tracer)
+        try:
+            return self._run_modpacks(c, args)
+        finally:
+            if args.trace is not None:
+                tracer.write(args.trace)
+                self.logger.info("Wrote trace to %s", args.trace)
+
+    def _run_modpacks(self, c, args):
+        exit_status = 0
+        if args.dry_run:
+            exit_status = self.run_dry_run(c, args)
+        elif args.batch is not None:
+            exit_status = self.run_batch(c, args)
+        else:
+            action_method = c.upgrade_modpack if args.upgrade else c.install_modpack
+            project_id, file_id = c.url_to_project_and_file(args.modpack_url)
+            action_method(project_id, file_id, args.instance_name)
+            self.logger.info("Done installing modpack %s as instance %s", args.modpack_url, args.instance_name)
+
+        if args.cache_max_size is not None:
+            c.downloader.enforce_size_limit(args.cache_max_size)
+        return exit_status
+
+    def run_dry_run(self, client, args):
+        default_mode = "upgrade" if args.upgrade else "install"
+        if args.batch is not None:
+            setups, invalid_entries = self.read_batch_spec(client, args.batch, default_mode)
+            for instance_name, _, error in invalid_entries:
+                self.logger.error("Skipping instance %s: %s", instance_name, error)
+        else:
+            invalid_entries = list()
+            project_id, file_id = client.url_to_project_and_file(args.modpack_url)
+            setups = [ModpackSetup(client, default_mode, project_id, file_id, args.instance_name)]
+        for setup in setups:
+            setup.resolve()
+        plan = client.plan_downloads(client.wanted_files(setups))
+        self.print_plan(setups, plan)
+        return 1 if plan.errors or invalid_entries else 0
+
+    def print_plan(self, setups, plan):
+        for setup in setups:
+            print("{:<30} {:<8} keep {}, remove {}, install {}".format(
+                setup.instance_name, setup.mode, len(setup.kept_files), len(setup.stale_files),
+                len(setup.files_to_fetch)
+            ))
+        print("")
+        print("{:<10} {:<10} {:<40} {:>10}  {}".format("Project", "File", "Filename", "Size", "Status"))
+        for d in plan.schedule():
+            if d.error is not None:
+                status = "unresolved: {}".format(d.error)
+            else:
+                status = "cached" if d.cached else "download"
+                if str(d.file_id) != str(d.modpack_file.file_id):
+                    status += " (replaces missing file {})".format(d.modpack_file.file_id)
+            size = format_size(d.size) if d.size is not None else "?"
+            print("{:<10} {:<10} {:<40} {:>10}  {}".format(
+                str(d.key[0]), str(d.file_id), d.filename or "?", size, status
+            ))
+        print("")
+        print("{} files: {} cached, {} to download ({}{}), {} unresolved".format(
+            len(plan.downloads), len(plan.hits), len(plan.misses), format_size(plan.download_size),
+            " plus files of unknown size" if any(d.size is None for d in plan.misses) else "",
+            len(plan.errors)
+        ))
+
+    def run_batch(self, client, args):
+        setups, invalid_entries = self.read_batch_spec(client, args.batch, "upgrade" if args.upgrade else "install")
+        results = [(s.instance_name, s.mode, error) for s, error in client.setup_modpacks(setups)]
+        results.extend(invalid_entries)
+
+        print("")
+        for instance_name, mode, error in results:
+            status = "ok" if error is None else "FAILED: {}".format(error)
+            print("{:<30} {:<8} {}".format(instance_name, mode, status))
+        failures = len([e for _, _, e in results if e is not None])
+        print("{} of {} instances set up successfully".format(len(results) - failures, len(results)))
+        return 1 if failures else 0
+
+    def read_batch_spec(self, client, path, default_mode):
+        """
+        Reads a batch spec file, returning a list of ModpackSetup and a list of
+        (instance name, mode, exception) tuples for entries whose modpack URL is invalid.
+        Those entries fail on their own rather than failing the whole batch.
+        """
+        try:
+            with open(path, "r") as f:
+                spec = json.loads(f.read())
+        except (OSError, ValueError) as e:
+            raise InvalidBatchSpecError("Could not read batch spec {}: {}".format(path, e))
+        if not isinstance(spec, list):
+            raise InvalidBatchSpecError("Batch spec {} must contain a list of modpacks".format(path))
+
+        setups = list()
+        invalid_entries = list()
+        instance_names = set()
+        for entry in spec:
+            try:
+                url, instance_name = entry["url"], entry["instance"]
+                mode = entry.get("mode", default_mode)
+            except (KeyError, TypeError, AttributeError):
+                raise InvalidBatchSpecError("Batch spec entry {!r} needs a url and an instance".format(entry))
+            if mode not in ("install", "upgrade"):
+                raise InvalidBatchSpecError("Batch spec entry {!r} has an invalid mode".format(entry))
+            if instance_name in instance_names:
+                raise InvalidBatchSpecError("Instance {} is listed more than once".format(instance_name))
+            instance_names.add(instance_name)
+            try:
+                project_id, file_id = client.url_to_project_and_file(url)
+            except InvalidCurseModpackUrlError as e:
+                invalid_entries.append((instance_name, mode, e))
+                continue
+            setups.append(ModpackSetup(client, mode, project_id, file_id, instance_name))
+        return setups, invalid_entries
+
+    def run_prefetch_command(self, argv):
+        args = self.parse_args(self.prefetch_argparser, argv)
         self.configure_logging(args.log_level)
         c = self.make_curseforge_client(args)
+        modpacks = [c.url_to_project_and_file(url) for url in args.modpack_urls]
+        results = c.prefetch_modpacks(modpacks)
+        if args.cache_max_size is not None:
+            c.downloader.enforce_size_limit(args.cache_max_size)
 
-        action_method = c.upgrade_modpack if args.upgrade else c.install_modpack
-        project_id, file_id = c.url_to_project_and_file(args.modpack_url)
-        action_method(project_id, file_id, args.instance_name)
-        self.logger.info("Done installing modpack %s as instance %s", args.modpack_url, args.instance_name)
+        for url, (_, error) in zip(args.modpack_urls, results):
+            print("{:<60} {}".format(url, "ok" if error is None else "FAILED: {}".format(error)))
+        return 1 if any(e is not None for _, e in results) else 0
+
+    def run_serve_command(self, argv):
+        args = self.parse_args(self.serve_argparser, argv)
+        self.configure_logging(args.log_level)
+        c = self.make_curseforge_client(args)
+        server = MirrorServer(c, args.bind, args.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if args.cache_max_size is not None:
+                c.downloader.enforce_size_limit(args.cache_max_size)
+        return 0
+
+    def run_cache_command(self, argv):
+        args = self.parse_args(self.cache_argparser, argv)
+        self.configure_logging(args.log_level)
+        downloader = self.make_downloader(args)
+
+        if args.cache_command == "gc":
+            size_before = downloader.index.total_size()
+            downloader.collect_garbage(args.cache_max_size)
+            print("Cache size reduced from {} to {}".format(
+                format_size(size_before), format_size(downloader.index.total_size())
+            ))
+        elif args.cache_command == "stats":
+            self.print_cache_stats(downloader.index)
+
+    def print_cache_stats(self, index):
+        counters = index.counters()
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        lookups = hits + misses
+        print("Cached URLs:      {}".format(len(index.entries())))
+        print("Cache size:       {}".format(format_size(index.total_size())))
+        print("Hits / misses:    {} / {} ({:.1%} hit rate)".format(hits, misses, hits / lookups if lookups else 0))
+        print("Downloaded:       {}".format(format_size(counters.get("bytes_downloaded", 0))))
+        print("Revalidations:    {}".format(counters.get("revalidations", 0)))
+        print("Download retries: {}".format(counters.get("retries", 0)))
+        print("Evictions:        {}".format(counters.get("evictions", 0)))
+        print("Adopted locally:  {}".format(counters.get("adopted", 0)))
+        print("")
+        print("{:<20} {:>8} {:>12}".format("Project", "Files", "Size"))
+        for project_id, file_count, size in index.size_by_project():
+            print("{:<20} {:>8} {:>12}".format(project_id or "(other)", file_count, format_size(size)))
 
 
 class MultiMcInstanceManager:
-    def __init__(self, multimc_directory, downloader):
+    def __init__(self, multimc_directory, downloader, tracer=None, forge_meta_url=None):
         self.multimc_directory = multimc_directory
         self.downloader = downloader
+        self.forge_meta_url = forge_meta_url
+        self.tracer = tracer if tracer is not None else Tracer()
 
     def create(self, instance_name, minecraft_version, forge_version):
         instance = self.instance(instance_name)
@@ -416,8 +2993,9 @@ class MultiMcInstance:
         self.instance_manager = instance_manager
 
     def configure(self, minecraft_version, forge_version, icon_key=None):
-        self._configure_instance_base(minecraft_version, icon_key)
-        self._configure_instance_forge(minecraft_version, forge_version)
+        with self.instance_manager.tracer.phase("configure_instance", instance=self.name):
+            self._configure_instance_base(minecraft_version, icon_key)
+            self._configure_instance_forge(minecraft_version, forge_version)
 
     def create(self, minecraft_version, forge_version, icon_path=None):
         self.logger.info("Creating MultiMC instance %s, Minecraft version %s, Forge version %s",
@@ -431,20 +3009,68 @@ class MultiMcInstance:
         if icon_path is not None:
             multimc_icon_filename = "mccdl_" + os.path.basename(icon_path)
             multimc_icon_key = os.path.splitext(multimc_icon_filename)[0]
-            shutil.copyfile(
+            copy_file(
                 icon_path, os.path.join(self.instance_manager.multimc_directory, "icons", multimc_icon_filename)
             )
         self.configure(minecraft_version, forge_version, icon_key=multimc_icon_key)
 
     def upgrade(self, minecraft_version, forge_version):
-        try:
-            shutil.rmtree(self.mods_directory)
-        except FileNotFoundError:
-            pass
-        os.makedirs(self.mods_directory)
+        if os.path.exists(self.lockfile_path):
+            # The lockfile tells us which mods we installed, so they can be
+            # upgraded one by one instead of starting from an empty directory.
+            os.makedirs(self.mods_directory, exist_ok=True)
+        else:
+            self.logger.warning("Instance %s has no mccdl lockfile, removing all of its mods", self.name)
+            try:
+                shutil.rmtree(self.mods_directory)
+            except FileNotFoundError:
+                pass
+            os.makedirs(self.mods_directory)
 
         self.configure(minecraft_version, forge_version)
 
+    def read_lockfile(self):
+        return InstanceLockfile.load(self.lockfile_path)
+
+    def write_lockfile(self, lockfile):
+        lockfile.save(self.lockfile_path)
+
+    def installed_file(self, modpack_file, cached_file, path):
+        """
+        Returns an InstalledFile recording that cached_file was installed at path for modpack_file.
+        """
+        st = os.stat(path)
+        return InstalledFile(modpack_file.project_id, modpack_file.file_id, os.path.relpath(path, self.directory),
+                             cached_file.sha256, st.st_size, st.st_mtime_ns)
+
+    def installed_file_intact(self, installed_file):
+        """
+        Returns True if installed_file is still present in this instance, unmodified.
+        """
+        path = os.path.join(self.directory, installed_file.path)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if st.st_size != installed_file.size:
+            return False
+        if st.st_mtime_ns == installed_file.mtime_ns:
+            return True
+        return sha256_file(path) == installed_file.sha256
+
+    def remove_installed_file(self, installed_file):
+        """
+        Removes a file that mccdl installed, unless it was modified since.
+        """
+        path = os.path.join(self.directory, installed_file.path)
+        if not os.path.lexists(path):
+            return
+        if not self.installed_file_intact(installed_file):
+            self.logger.warning("Not removing %s, it was modified after mccdl installed it", path)
+            return
+        self.logger.debug("Removing %s", path)
+        os.unlink(path)
+
     def _apply_instance_options(self, options={}):
         with open(self.instance_cfg, "r+") as f:
             f.seek(0, os.SEEK_SET)
@@ -470,13 +3096,14 @@ class MultiMcInstance:
         self.logger.debug("Configuring MultiMC instance Forge")
         patches_dir = os.path.join(self.directory, "patches")
         self.instance_manager.downloader.download(
-            self._forge_config_url(forge_version),
+            self.forge_config_url(forge_version, self.instance_manager.forge_meta_url),
             os.path.join(patches_dir, "net.minecraftforge.json")
         )
 
-    def _forge_config_url(self, forge_version):
+    @classmethod
+    def forge_config_url(cls, forge_version, site=None):
         forge_config_filename = "{}.json".format(forge_version)
-        return urljoin(self.MULTIMC_FORGE_CONFIGURATION_SITE, forge_config_filename)
+        return urljoin(site if site is not None else cls.MULTIMC_FORGE_CONFIGURATION_SITE, forge_config_filename)
 
     def _set_default_instance_cfg(self):
         instance_cfg_content = textwrap.dedent("""
@@ -501,6 +3128,10 @@ class MultiMcInstance:
     def instance_cfg(self):
         return os.path.join(self.directory, "instance.cfg")
 
+    @property
+    def lockfile_path(self):
+        return os.path.join(self.directory, "mccdl.lock.json")
+
 
 class MccdlError(Exception):
     """
@@ -515,11 +3146,66 @@ class InvalidCurseModpackUrlError(MccdlError):
     """
 
 
+class StageCancelledError(MccdlError):
+    """
+    Exception raised by a stage of a StagePipeline that was cancelled because another
+    stage failed.
+    """
+
+
 class MultiMcInstanceExistsError(MccdlError):
     """
     Exception raised when a user tries to create a MultiMC instance that already exists.
     """
 
 
+class InvalidBatchSpecError(MccdlError):
+    """
+    Exception raised when a batch spec file cannot be read or is malformed.
+    """
+
+
+class InvalidModpackError(MccdlError):
+    """
+    Exception raised when a modpack archive is malformed or unsafe to install.
+    """
+
+
+class OfflineError(MccdlError):
+    """
+    Exception raised when mccdl needs something from the network while running offline.
+    """
+
+
+class DownloadNotFoundError(MccdlError):
+    """
+    Exception raised when the server reports that a file to be downloaded does not exist.
+    """
+
+
+class IncompleteDownloadError(MccdlError):
+    """
+    Exception raised when a download ends before the size announced by the server was reached,
+    or the connection fails while the body is being received.
+
+    The bytes received so far are kept so that the next attempt can resume the download.
+    """
+
+
+class ModpackDownloadError(MccdlError):
+    """
+    Exception raised when one or more files in a modpack could not be downloaded.
+
+    The errors attribute is a list of (CurseForgeModPackFile, exception) tuples.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("Failed to download {} modpack file(s): {}".format(
+            len(errors),
+            ", ".join("{}/{}".format(f.project_id, f.file_id) for f, _ in errors)
+        ))
+
+
 if __name__ == "__main__":
-    MccdlCommandLineApplication().run(sys.argv[1:])
+    sys.exit(MccdlCommandLineApplication().run(sys.argv[1:]))